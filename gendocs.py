@@ -8,50 +8,100 @@
 # participate in documentation regeneration
 
 import os
+import json
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from inspect import signature, getsource
 from pygentic.jinja_env import env
 from pygentic.tool_calling import tool_registry
 from pygentic.llm_backends import LlamaCpp, GenerationSpec
 from pygentic.completion import TextCompleter
-from pygentic import ChatHistory, default_template, Thread, TextSection, Message
+from pygentic.messages import JinjaChatFactory
 from pygentic.tool_calling import default_tool_use_backend
 
 
-def generate_docs(function_template, completer, output_dir):
-    system_message = "Whatever"
+def generate_docs(function_template, create_completer, output_dir, concurrency=4):
+    """Generates documentation for every registered tool, running up to "concurrency" requests at once.
 
-    llama_template = default_template
+    create_completer is called once per tool, so that concurrent requests do not share LLM state.
+    Tools whose source code did not change since their documentation was saved are skipped.
+    """
+    func_template = env.get_template(function_template)
 
-    history = ChatHistory(system_message, llama_template)
+    index_path = os.path.join(output_dir, 'index.json')
+    index = load_index(index_path)
 
-    func_template = env.get_template(function_template)
+    outdated = {name: func for name, func in tool_registry.items() if not is_documented(index, name, func)}
 
-    tool_use_helper = default_tool_use_backend()
+    for name in tool_registry:
+        if name not in outdated:
+            print(f'Documentation for "{name}" function is up to date, skipping')
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(document_tool, name, func, create_completer(), func_template, output_dir): name
+                   for name, func in outdated.items()}
+
+        for future in as_completed(futures):
+            name = futures[future]
+            doc_file = future.result()
+            index[name] = {"hash": source_hash(tool_registry[name]), "doc_file": doc_file}
+            # saved after every tool, so that an interrupted run can be resumed
+            save_index(index_path, index)
 
-    for name, func in tool_registry.items():
-        src = getsource(func)
 
-        prompt = "Create a high quality documentation for the following function:\n\n" + src
-        history.add_message(prompt)
-        input_text = history.full_text()
+def source_hash(func):
+    return hashlib.blake2b(getsource(func).encode('utf-8')).hexdigest()
 
-        doc_str = completer(input_text)
 
-        history.add_message(func_doc)
+def is_documented(index, name, func):
+    entry = index.get(name)
+    if not entry:
+        return False
+    return entry["hash"] == source_hash(func) and os.path.isfile(entry["doc_file"])
 
-        sig = signature(func)
-        examples = []
-        if hasattr(func, 'usage_examples'):
-            for arg_dict in func.usage_examples:
-                tool_use_str = tool_use_helper.render(name, arg_dict)
-                examples.append(tool_use_str)
 
-        func_doc = func_template.render(name=name, signature=str(sig), doctext=doc_str, usage_examples=examples)
-        doc_file = os.path.join(output_dir, name + '.txt')
-        with open(doc_file, "w") as f:
-            f.write(doc_file)
-        print(f'Saved documentation for "{name}" function to "{doc_file}"')
+def load_index(path):
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(path, index):
+    with open(path, "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def document_tool(name, func, completer, func_template, output_dir):
+    system_message = "Whatever"
+
+    tool_use_helper = default_tool_use_backend()
+    chat_factory = JinjaChatFactory('llama3', tool_use_helper)
+    render = chat_factory.get_chat_renderer()
+
+    src = getsource(func)
+
+    prompt = "Create a high quality documentation for the following function:\n\n" + src
+    history = [chat_factory.create_system_msg(system_message), chat_factory.create_user_msg(prompt)]
+    input_text = render(history)
+
+    doc_str = completer(input_text)
+
+    sig = signature(func)
+    examples = []
+    if hasattr(func, 'usage_examples'):
+        for arg_dict in func.usage_examples:
+            tool_use_str = tool_use_helper.render_tool_call(name, arg_dict)
+            examples.append(tool_use_str)
+
+    func_doc = func_template.render(name=name, signature=str(sig), doctext=doc_str, usage_examples=examples)
+    doc_file = os.path.join(output_dir, name + '.txt')
+    with open(doc_file, "w") as f:
+        f.write(func_doc)
+    print(f'Saved documentation for "{name}" function to "{doc_file}"')
+    return doc_file
 
 
 if __name__ == '__main__':
@@ -61,13 +111,13 @@ if __name__ == '__main__':
     parser.add_argument('--function_template', type=str, default="function_doc.jinja")
 
     parser.add_argument('--output_dir', type=str, default="docs")
+    parser.add_argument('--concurrency', type=int, default=4)
 
     spec = GenerationSpec({}, stop_word=None)
     args = parser.parse_args()
 
-    llm = LlamaCpp(args.base_url, spec, proxies={})
-    completer = TextCompleter(llm)
-
-    tool_use_helper = default_tool_use_backend()
+    def create_completer():
+        llm = LlamaCpp(args.base_url, spec, proxies={})
+        return TextCompleter(llm)
 
-    generate_docs(args.function_template, completer, args.output_dir)
\ No newline at end of file
+    generate_docs(args.function_template, create_completer, args.output_dir, args.concurrency)
@@ -1,9 +1,11 @@
 from __future__ import annotations
-import json
-import sys
 import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .chat_render import ChatRendererToString, default_template
-from .llm_backends import BaseLLM, LlamaCpp, GenerationSpec
+from .llm_backends import BaseLLM, LlamaCpp, GenerationSpec, ResponseCache, is_deterministic
 from .tools import *
 from .completion import *
 from .completion import RunOutOfContextError, ParentOutOfContextError
@@ -11,37 +13,64 @@ from .tool_calling import *
 from .misc import Message, TextSection, ToolCallSection, ResultSection
 from .loaders import FileTreeLoader, FileLoadingConfig
 from .messenger import TokenArrivedEvent, GenerationCompleteEvent, messenger
-from .messages import JinjaChatFactory, collate
+from .messages import JinjaChatFactory, ToolResult, collate
+from . import serialization
+from .context import ContextManager, TruncatingContextManager
 
 
 class GeneratorWithRetries:
-    def __init__(self, llm, max_retries=3, max_continue=3):
+    def __init__(self, llm, max_retries=3, max_continue=3, cache=None, backoff=0):
         self.llm = llm
         self.max_retries = max_retries
         self.max_continue = max_continue
+        self.cache = cache
+        self.backoff = backoff
 
     def __call__(self, input_text):
-        response = self._try_generate(input_text, self.max_retries)
+        # only greedy output of a backend that can describe its settings is reused
+        cache_namespace = getattr(self.llm, "cache_namespace", None)
+        if self.cache is None or cache_namespace is None or not is_deterministic(self.llm):
+            return self._generate(input_text)
+
+        key = self.cache.make_key(input_text, cache_namespace())
+        response = self.cache.get(key)
+        if response is None:
+            response = self._generate(input_text)
+            self.cache.put(key, response)
+        return response
+
+    def _generate(self, input_text):
+        chunks = [self._try_generate(input_text)]
+        response = chunks[0]
         for _ in range(self.max_continue):
-            if self.incomplete_response(response):
-                response += self._try_generate(response, self.max_retries)
+            if not self.incomplete_response(response):
+                break
+            # continue the same prompt; only the newly generated tail is appended
+            chunks.append(self._try_generate(input_text + response))
+            response = "".join(chunks)
         return response
 
     def incomplete_response(self, text):
         # todo: implement this
         return False
 
-    def _try_generate(self, input_text, tries):
-        try:
-            return self.llm(input_text)
-        except Exception:
-            if tries > 0:
-                return self._try_generate(input_text, tries - 1)
-            else:
-                raise
+    def _try_generate(self, input_text):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.llm(input_text)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                if self.backoff:
+                    time.sleep(self.backoff * 2 ** attempt)
 
 
 class OutputDevice:
+    @property
+    def wants_text(self):
+        # devices that keep the default __call__ discard message text, so it need not be rendered
+        return type(self).__call__ is not OutputDevice.__call__
+
     def __call__(self, new_text):
         pass
 
@@ -50,55 +79,114 @@ class OutputDevice:
 
 
 class FileOutputDevice(OutputDevice):
-    def __init__(self, file_path):
+    def __init__(self, file_path, buffer_size=1 << 16):
         self.file_path = file_path
+        self.buffer_size = buffer_size
         self.cache = TextCache()
 
+        # opened on first write and kept open, instead of reopening the file for every token
+        self.file = None
+
     def on_token(self, token):
         self.cache.fill(token)
 
         # todo: save only tokens of text modality
         self.append_file(token)
 
+        # tokens are flushed line by line, so that the file can still be followed live
+        if '\n' in token:
+            self.flush()
+
     def __call__(self, new_text):
         new_text = self.cache(new_text)
         if new_text:
             new_text += '\n'
         self.append_file(new_text)
+        self.flush()
 
     def append_file(self, text):
-        with open(self.file_path, 'a') as f:
-            f.write(text)
+        if self.file is None:
+            self.file = open(self.file_path, 'a', buffering=self.buffer_size)
+        self.file.write(text)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TokenBatcher:
+    """Passes streamed tokens on to an output device in batches instead of one by one"""
+    def __init__(self, output_device, batch_size=32, boundaries=('\n', '.', '?', '!')):
+        self.output_device = output_device
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.pending = []
+
+    def __call__(self, token):
+        self.pending.append(token)
+        if len(self.pending) >= self.batch_size or token.endswith(self.boundaries):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.output_device.on_token("".join(self.pending))
+            self.pending.clear()
 
 
 class TextCache:
     def __init__(self):
-        self.buffer = ""
+        # streamed tokens are joined lazily, so that filling the cache does not copy the buffer
+        self.chunks = []
+
+    @property
+    def buffer(self):
+        return "".join(self.chunks)
 
     def fill(self, text):
-        self.buffer += text
+        self.chunks.append(text)
 
     def __call__(self, text):
         """Returns a suffix of "text" starting with the first character after common prefix"""
-        n = get_common_prefix_length(self.buffer, text)
-        self.buffer = self.buffer[n:]
+        buffer = self.buffer
+        n = get_common_prefix_length(buffer, text)
+        rest = buffer[n:]
+        self.chunks = [rest] if rest else []
         return text[n:]
 
 
 def get_common_prefix_length(s1, s2):
-    count = 0
-    for ch1, ch2 in zip(s1, s2):
-        if ch1 != ch2: break
-        count += 1
-    
-    return count
+    n = min(len(s1), len(s2))
+    if s1[:n] == s2[:n]:
+        return n
+
+    # binary search for the first mismatch, comparing slices instead of single characters
+    lo, hi = 0, n
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if s1[lo:mid] == s2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
 
 
 class Agent:
     default_done_tool = lambda *args, **kwargs: kwargs
 
     def __init__(self, llm, tools, done_tool=None, system_message="",
-                 max_rounds=5, output_device=None, temp_output_device=None):
+                 max_rounds=5, output_device=None, temp_output_device=None,
+                 context_manager=None):
         self.llm = llm
         self.tools = tools
         self.done_tool = done_tool or self.default_done_tool
@@ -106,17 +194,28 @@ class Agent:
         self.max_rounds = max_rounds
         self.output_device = output_device or OutputDevice()
         self.temp_output_device = temp_output_device or self.create_temp_terminal()
+        self.context_manager = context_manager or ContextManager()
 
         self.sub_agents = {}
         self.parent = None
 
+        # sub-agents running concurrently take turns asking this agent questions,
+        # since answering uses its completer and LLM
+        self.clarify_lock = threading.Lock()
+
         self.loading_config = FileLoadingConfig.empty_config()
 
         self.history = []
 
-        self.tool_use_helper = SimpleTagBasedToolUse.create_default()
+        self.tool_use_helper = default_tool_use_backend()
         self.chat_factory = JinjaChatFactory('llama3', self.tool_use_helper)
-        self.chat_renderer = self.chat_factory.get_chat_renderer()
+        self.chat_renderer = self.chat_factory.get_incremental_chat_renderer()
+
+        self.tool_caller = ToolCaller(self, self.chat_factory)
+        self.action_handlers = {
+            "delegate": Delegator(self, self.chat_factory),
+            "clarify": self._clarify
+        }
 
     def create_temp_terminal(self):
         if not isinstance(self.output_device, FileOutputDevice):
@@ -145,21 +244,29 @@ class Agent:
 
         prompt = self._prepare_prompt_message(inputs, files)
 
-        self.output_device(system_message.content.render())
-        self.output_device(prompt.content.render())
+        self._show(system_message)
+        self._show(prompt)
 
-        self.completer = completer = TextCompleter(self.llm)
+        stop_sequences = [tool_use_helper.end_tag]
+        self.completer = completer = TextCompleter(self.llm, stop_sequences)
 
+        self.token_batcher = TokenBatcher(self.output_device)
         completer.on_token = self._stream_to_device(tool_use_helper)
 
+        # history keeps messages of earlier calls, the current call starts here
+        call_start = len(self.history)
         self.history.append(system_message)
         self.history.append(prompt)
 
         blank_count = 0
 
         for _ in range(self.max_rounds):
-            input_text = self.chat_renderer(self.history)
-            response = completer(input_text)
+            input_text = self.chat_renderer(self.context_manager(self.history, call_start))
+            try:
+                response = completer(input_text)
+            finally:
+                # streamed text must reach the device before the final message is rendered to it
+                self.token_batcher.flush()
 
             if self._blank_response(response):
                 blank_count += 1
@@ -174,110 +281,120 @@ class Agent:
                     print("Generated 3 blanks!!!")
                     continue
 
-            try:
-                self._process_response(response)
-            except SolutionComplete as result:
-                arg_dict = result.args[0]
-                done_tool_call = self.chat_factory.create_tool_call('done_tool', arg_dict)
-                self.output_device(done_tool_call.content.render())
-                return result.args[0]
+            # without the end tag the response cannot hold a complete tool call
+            has_end_tag = completer.stopped_on == tool_use_helper.end_tag
+            result = self._process_response(response, has_end_tag)
+            if result.response_type == BaseResponse.solution:
+                done_tool_call = self.chat_factory.create_tool_call('done_tool', result.arg_dict)
+                self._show(done_tool_call)
+                return result.arg_dict
 
         raise TooManyRoundsError('Too many rounds of generation')
 
+    async def acall(self, inputs, files=None):
+        """Runs the agent in a worker thread, so that several agents can be awaited concurrently"""
+        return await asyncio.to_thread(self, inputs, files)
+
     def _blank_response(self, response):
         return not response.replace("\n", "").strip()
 
-    def _process_response(self, response):
-        if not self.tool_use_helper.contains_tool_use(response):
+    def _process_response(self, response, has_end_tag=True):
+        match = self.tool_use_helper.search(response) if has_end_tag else None
+        if match is None:
             self._create_and_process_message(self.chat_factory.create_ai_msg, response)
-            return
+            return RegularResponse(response)
 
-        offset, length, body = self.tool_use_helper.find(response)
+        offset, length, body = match
         pre_tool_text = response[:offset]
         self._create_and_process_message(self.chat_factory.create_ai_msg, pre_tool_text)
 
-        try:
-            action, arg_dict = self._get_action(body)
-        except InvalidJsonError as exc:
-            error, body = exc.args
+        parsed, error = self.tool_use_helper.try_parse(body)
+        if error:
             self._create_and_process_message(self.chat_factory.create_raw_tool_call, body)
             self._create_and_process_message(self.chat_factory.create_tool_parse_error, error)
-        else:
-            self._create_and_process_message(self.chat_factory.create_tool_call, action, arg_dict)
-            self._perform_action(action, arg_dict)
+            return RegularResponse(response)
+
+        action, arg_dict = parsed
+        self._create_and_process_message(self.chat_factory.create_tool_call, action, arg_dict)
+
+        if action == "done_tool":
+            return SolutionResponse(response, arg_dict)
+
+        self._perform_action(action, arg_dict)
+        return RegularResponse(response)
 
     def _create_and_process_message(self, create_fn, *args):
         msg = create_fn(*args)
         self.history.append(msg)
-        self.output_device(msg.content.render())
+        self._show(msg)
 
-    def _get_action(self, body):
-        try:
-            tool_name, arg_dict = self.tool_use_helper.parse(body)
-            return tool_name, arg_dict
-        except ValueError as e:
-            raise InvalidJsonError(e.args[0], body)
+    def _show(self, msg):
+        if self.output_device.wants_text:
+            self.output_device(msg.content.render())
 
     def _perform_action(self, action, arg_dict):
-        if action == "done_tool":
-            raise SolutionComplete(arg_dict)
-
-        if action == "delegate":
-            actor = Delegator(self, self.chat_factory)
-            msg = actor(action, arg_dict)
-        elif action == "clarify":
-            assistant = AiAssistant(self.parent) if self.parent else NullAssistant()
-            text = arg_dict["text"]
-            response = assistant.ask_question(text)
-            msg = self.chat_factory.create_user_msg(response)
-        else:
-            actor = ToolCaller(self, self.chat_factory)
-            msg = actor(action, arg_dict)
-        
+        handler = self.action_handlers.get(action, self.tool_caller)
+        msg = handler(action, arg_dict)
+
         self.history.append(msg)
-        self.output_device(msg.content.render())
+        self._show(msg)
+
+    def _clarify(self, action, arg_dict):
+        assistant = AiAssistant(self.parent) if self.parent else NullAssistant()
+        text = arg_dict["text"]
+        response = assistant.ask_question(text)
+        return self.chat_factory.create_user_msg(response)
 
     def _stream_to_device(self, tool_use_helper):
-        # todo: refactor
+        start_tag = tool_use_helper.start_tag
+        end_tag = tool_use_helper.end_tag
+
+        # only a short tail of the text streamed so far may hold a tag split across tokens
+        tail_length = max(len(start_tag), len(end_tag)) - 1
         tool_use_seq = False
-        buffer = ""
-        def on_token(token):
-            nonlocal tool_use_seq, buffer
-            buffer += token
+        tail = ""
 
-            #print(tool_use_helper.start_tag, buffer[-40:], bool(tool_use_helper.start_tag in buffer))
+        def on_token(token):
+            nonlocal tool_use_seq, tail
 
             if not tool_use_seq:
-                self.output_device.on_token(token)
-
-            if tool_use_helper.start_tag in buffer:
-                tool_use_seq = True
-                idx = buffer.index(tool_use_helper.start_tag)
-                buffer = buffer[idx + len(buffer):]
-            
-            if tool_use_helper.end_tag in buffer:
-                tool_use_seq = False
-                idx = buffer.index(tool_use_helper.end_tag)
-                buffer = buffer[idx + len(buffer):]
+                self.token_batcher(token)
+
+            window = tail + token
+            while True:
+                tag = end_tag if tool_use_seq else start_tag
+                idx = window.find(tag)
+                if idx < 0:
+                    break
+                tool_use_seq = not tool_use_seq
+                window = window[idx + len(tag):]
+
+            tail = window[max(0, len(window) - tail_length):]
         return on_token
 
     def backup_history(self):
-        self.backup = self.history[:]
+        # history is only ever appended to, so its length is enough to restore it
+        self.backup = len(self.history)
 
     def restore_history(self):
-        self.history = self.backup[:]
+        del self.history[self.backup:]
 
     def _prepare_prompt_message(self, inputs, files):
         inputs = dict(inputs)
         files = files or []
 
-        files_content = []
-        for file_entry in files:
-            path = file_entry['path']
-            sections = FileTreeLoader(self.loading_config, self.chat_factory)(path)
-            files_content.extend(sections)
+        loader = FileTreeLoader(self.loading_config, self.chat_factory)
+        paths = [file_entry['path'] for file_entry in files]
+        if len(paths) > 1:
+            # file trees are loaded concurrently, results are kept in the order of files
+            with ThreadPoolExecutor(max_workers=min(8, len(paths))) as executor:
+                loaded = list(executor.map(loader, paths))
+        else:
+            loaded = [loader(path) for path in paths]
 
-        prompt_text = json.dumps(inputs)
+        files_content = [section for sections in loaded for section in sections]
+
+        prompt_text = serialization.dumps(inputs)
         messages = files_content + [self.chat_factory.create_user_msg(prompt_text)]
         return collate(messages)
 
@@ -290,21 +407,34 @@ class NullAssistant:
 class AiAssistant(NullAssistant):
     def __init__(self, parent_agent):
         self.completer = parent_agent.completer
+        self.token_batcher = parent_agent.token_batcher
+        self.lock = parent_agent.clarify_lock
         self.history = parent_agent.history[:]
         self.output_device =  parent_agent.temp_output_device
         self.chat_factory = parent_agent.chat_factory
 
+        # the history starts as a copy of the parent's, so the text rendered for it is reused
+        self.chat_renderer = parent_agent.chat_renderer.clone()
+
     def ask_question(self, text):
+        with self.lock:
+            return self._ask_question(text)
+
+    def _ask_question(self, text):
         msg = self.chat_factory.create_user_msg(f'Message from an agent who you delegated latest task to: {text}')
         self.history.append(msg)
         self.output_device(text)
 
-        input_text = self.chat_factory.get_chat_renderer()(self.history)
+        input_text = self.chat_renderer(self.history)
 
         try:
             response = self.completer(input_text)
         except RunOutOfContextError as e:
             raise ParentOutOfContextError(*e.args)
+        finally:
+            # the answer streams through the parent's batcher; it must reach the device
+            # before the parent goes on rendering messages to it
+            self.token_batcher.flush()
 
         msg = self.chat_factory.create_ai_msg(response)
         self.history.append(msg)
@@ -312,16 +442,19 @@ class AiAssistant(NullAssistant):
         return response
 
 
-class SolutionComplete(Exception):
-    pass
-
-
 class Delegator:
     def __init__(self, agent, chat_factory):
         self.agent = agent
         self.chat_factory = chat_factory
 
     def __call__(self, action, arg_dict):
+        if isinstance(arg_dict.get("name"), list):
+            return self._fan_out(action, arg_dict)
+
+        name = arg_dict.get("name")
+        if not isinstance(name, str) or name not in self.agent.sub_agents:
+            return self.chat_factory.create_tool_error(action, f'Sub-agent "{name}" not found')
+
         try:
             result = self._delegate(arg_dict)
             msg = self.chat_factory.create_tool_result(action, result)
@@ -336,17 +469,63 @@ class Delegator:
         sub_agent_inputs = arg_dict["inputs"]
         sub_agent = self.agent.sub_agents[name]
         self.agent.backup_history()
-        exc = None
-        for _ in range(retries):
-            self.agent.restore_history()
+        return self._call_with_retries(sub_agent, sub_agent_inputs, retries, self.agent.restore_history)
+
+    def _fan_out(self, action, arg_dict, retries=3):
+        """Runs several distinct sub-agents concurrently and reports all their results in one message"""
+        names = arg_dict["name"]
+        inputs = arg_dict["inputs"]
+        if not isinstance(inputs, list):
+            inputs = [inputs] * len(names)
+
+        if not all(isinstance(name, str) for name in names):
+            return self.chat_factory.create_tool_error(action, "Sub-agent names must be strings")
+
+        if not names or len(inputs) != len(names) or len(set(names)) != len(names):
+            error = "Delegating to several agents requires distinct names and one inputs object per name"
+            return self.chat_factory.create_tool_error(action, error)
 
+        unknown = [name for name in names if name not in self.agent.sub_agents]
+        if unknown:
+            return self.chat_factory.create_tool_error(action, f'Sub-agents not found: {", ".join(unknown)}')
+
+        sub_agents = [self.agent.sub_agents[name] for name in names]
+
+        # one agent registered under several names can't run on two threads at once
+        if len({id(sub_agent) for sub_agent in sub_agents}) != len(sub_agents):
+            error = "Delegating to several agents requires names of distinct sub-agents"
+            return self.chat_factory.create_tool_error(action, error)
+
+        # sub-agents run concurrently, so history is backed up once and not restored between attempts
+        self.agent.backup_history()
+        with ThreadPoolExecutor(max_workers=len(sub_agents)) as executor:
+            futures = [executor.submit(self._call_with_retries, sub_agent, sub_agent_inputs, retries)
+                       for sub_agent, sub_agent_inputs in zip(sub_agents, inputs)]
+
+        results = []
+        for name, future in zip(names, futures):
             try:
-                return sub_agent(sub_agent_inputs)
+                results.append({"name": name, "result": future.result()})
+            except ParentOutOfContextError as e:
+                raise RunOutOfContextError(*e.args)
             except RunOutOfContextError as e:
-                # todo: needs a way to clear conversation between parent and child before retry
-                exc = e
+                results.append({"name": name, "error": str(e)})
+        return self.chat_factory.create_tool_result(action, results)
 
-        raise exc
+    def _call_with_retries(self, sub_agent, sub_agent_inputs, retries=3, reset=None):
+        if retries < 1:
+            raise ValueError("retries must be at least 1")
+
+        for attempt in range(retries):
+            if reset:
+                reset()
+
+            try:
+                return sub_agent(sub_agent_inputs)
+            except RunOutOfContextError:
+                # todo: needs a way to clear conversation between parent and child before retry
+                if attempt == retries - 1:
+                    raise
 
 
 class Clarifier:
@@ -359,29 +538,40 @@ class Clarifier:
 
 
 class ToolCaller:
-    def __init__(self, agent, chat_factory):
+    def __init__(self, agent, chat_factory, cache=None):
         self.agent = agent
         self.chat_factory = chat_factory
 
+        # results of tools marked with @cacheable
+        self.cache = cache or ResponseCache()
+
     def __call__(self, action, arg_dict):
         tool_name = action
 
-        try:
-            result = self._use_tool(tool_name, arg_dict)
-            msg = self.chat_factory.create_tool_result(tool_name, result)
-        except Exception as e:
-            msg = self.chat_factory.create_tool_error(tool_name, str(e))
+        tool = self.agent.tools.get(tool_name)
+        if tool is None:
+            return self.chat_factory.create_tool_error(tool_name, f'Tool "{tool_name}" not found')
+
+        ttl = getattr(tool, 'cache_ttl', None)
+        if ttl is None:
+            return self._use_tool(tool_name, tool, arg_dict)
+
+        key = self.cache.make_key(serialization.canonical_dumps(arg_dict), tool_name)
+        msg = self.cache.get(key)
+        if msg is None:
+            msg = self._use_tool(tool_name, tool, arg_dict)
+            if isinstance(msg.content, ToolResult):
+                self.cache.put(key, msg, ttl)
         return msg
 
-    def _use_tool(self, tool_name, arg_dict):
-        if tool_name not in self.agent.tools:
-            raise ToolDoesNotExistError(f'Tool "{tool_name}" not found', tool_name)
+    def _use_tool(self, tool_name, tool, arg_dict):
         try:
-            return self.agent.tools[tool_name](**arg_dict)
-        except TypeError as e:
-            raise BadToolUseError(f'Calling tool "{tool_name}" resulted in error: {e.args[0]}')
+            result = tool(**arg_dict)
         except Exception as e:
-            raise ToolUseError(f'Calling tool "{tool_name}" resulted in error: {e.args[0]}')
+            error = f'Calling tool "{tool_name}" resulted in error: {e}'
+            return self.chat_factory.create_tool_error(tool_name, error)
+
+        return self.chat_factory.create_tool_result(tool_name, result)
 
 
 class UnknownActionError(Exception):
@@ -394,14 +584,13 @@ class TokenBudget:
         self.n_tokens = 0
 
     def increment(self, n=1):
+        # called for every generated token, so the quota is compared inline
         self.n_tokens += n
-        self._check()
+        if self.n_tokens > self.quota:
+            self._abort()
 
-    def _check(self):
-        total = self.n_tokens
-        if total > self.quota:
-            print(f'Aborted the script. Total # of generated tokens ({total}) has exceeded the quota ({self.quota})')
-            sys.exit()
+    def _abort(self):
+        raise BudgetExceededError(self.n_tokens, self.quota)
 
 
 def run_agent(agent, inputs, files=None, max_eval=100000, max_gen=10000, max_total=100000):
@@ -415,19 +604,24 @@ def run_agent(agent, inputs, files=None, max_eval=100000, max_gen=10000, max_tot
 
     def on_complete(data):
         _, response_data = data
-        num_eval = response_data["tokens_evaluated"]
+        # missing when generation was cut off before the server sent final stats
+        num_eval = response_data.get("tokens_evaluated", 0)
 
         input_budget.increment(num_eval)
         
         total = input_budget.n_tokens + output_budget.n_tokens
         if total > max_total:
-            print(f'Aborted the script. Total # of generated tokens ({total}) has exceeded the quota ({max_total})')
-            sys.exit()
+            raise BudgetExceededError(total, max_total)
 
     messenger.subscribe(TokenArrivedEvent.etype, on_token)
     messenger.subscribe(GenerationCompleteEvent.etype, on_complete)
 
-    return agent(inputs, files)
+    try:
+        return agent(inputs, files)
+    finally:
+        # otherwise budgets of finished runs keep receiving events of later runs
+        messenger.unsubscribe(TokenArrivedEvent.etype, on_token)
+        messenger.unsubscribe(GenerationCompleteEvent.etype, on_complete)
 
 
 class TooManyRoundsError(Exception):
@@ -435,4 +629,7 @@ class TooManyRoundsError(Exception):
 
 
 class BudgetExceededError(Exception):
-    pass
+    def __init__(self, n_tokens, quota):
+        super().__init__(f'Total # of generated tokens ({n_tokens}) has exceeded the quota ({quota})')
+        self.n_tokens = n_tokens
+        self.quota = quota
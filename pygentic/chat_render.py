@@ -1,3 +1,4 @@
+from functools import lru_cache
 from .jinja_env import env
 
 default_template = "llama_3.jinja"
@@ -13,6 +14,22 @@ class ChatRenderer:
 
 
 class ChatRendererToString(ChatRenderer):
+    def __init__(self, template_name, use_bos=False):
+        super().__init__(template_name, use_bos)
+        self._template = None
+
+    @property
+    def template(self):
+        # loaded on first use and kept, so that the template file is not looked up on every call
+        if self._template is None:
+            self._template = env.get_template(self.template_name)
+        return self._template
+
     def __call__(self, system_message, messages):
-        template = env.get_template(self.template_name)
-        return template.render(system_message=system_message, messages=messages)
+        return self.template.render(system_message=system_message, messages=messages)
+
+
+@lru_cache(maxsize=16)
+def get_renderer(template_name):
+    """Returns a shared renderer for the template"""
+    return ChatRendererToString(template_name)
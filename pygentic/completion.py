@@ -1,10 +1,10 @@
-from .chat_render import ChatRendererToString, default_template
+from .chat_render import ChatRendererToString, default_template, get_renderer
 from .tool_calling import SimpleTagBasedToolUse
 from .messenger import messenger, TokenArrivedEvent, GenerationCompleteEvent
 
 
 def render_messages_to_string(messages, system_message=''):
-    renderer = ChatRendererToString(default_template)
+    renderer = get_renderer(default_template)
     renderer(system_message, messages)
     return ""
 
@@ -12,19 +12,20 @@ def render_messages_to_string(messages, system_message=''):
 class ActionDispatcher:
     def __init__(self, agent, action_handlers: dict):
         self.agent = agent
-        self.action_handlers = action_handlers
 
-    def __call__(self, action_name, arg_dict):
-        if action_name == "failure":
-            raise ToolUseFailedError
+        # "failure" is folded into the table, so that every action costs a single lookup;
+        # tools are still looked up on every call, since agent.tools may change
+        self.action_handlers = dict(action_handlers, failure=raise_tool_use_failed)
 
+    def __call__(self, action_name, arg_dict):
         handler = self.action_handlers.get(action_name)
         if not handler:
-            if action_name not in self.agent.tools:
+            tool = self.agent.tools.get(action_name)
+            if tool is None:
                 raise ToolDoesNotExistError(f'Tool "{action_name}" not found', action_name)
 
             try:
-                return self.agent.tools[action_name](**arg_dict)
+                return tool(**arg_dict)
             except TypeError as e:
                 raise BadToolUseError(f'Calling tool "{action_name}" resulted in error: {e.args[0]}')
             except Exception as e:
@@ -37,24 +38,29 @@ class ToolUseFailedError(Exception):
     pass
 
 
+def raise_tool_use_failed(agent, arg_dict):
+    raise ToolUseFailedError
+
+
 def handle_clarify(agent, arg_dict):
     text = arg_dict["text"]
     return agent.parent.ask_question(text)
 
 
 def handle_delegate(agent, arg_dict, retries=3):
+    if retries < 1:
+        raise ValueError("retries must be at least 1")
+
     name = arg_dict["name"]
     sub_agent_inputs = arg_dict["inputs"]
     sub_agent = agent.sub_agents[name]
-    
-    exc = None
-    for _ in range(retries):
+
+    for attempt in range(retries):
         try:
             return sub_agent(sub_agent_inputs)
-        except RunOutOfContextError as e:
-            exc = e
-    
-    raise exc
+        except RunOutOfContextError:
+            if attempt == retries - 1:
+                raise
 
 
 def handle_tool_use(agent, arg_dict):
@@ -69,6 +75,8 @@ def handle_failure(agent, arg_dict):
 
 
 class BaseResponse:
+    __slots__ = ()
+
     pending_action = "pending_action"
     solution = "solution"
     failure = "failure"
@@ -76,12 +84,16 @@ class BaseResponse:
 
 
 class RegularResponse(BaseResponse):
+    __slots__ = ("text", "response_type")
+
     def __init__(self, text):
         self.text = text
         self.response_type = "regular_response"
 
 
 class SolutionResponse(BaseResponse):
+    __slots__ = ("text", "response_type", "arg_dict")
+
     def __init__(self, text, arg_dict):
         self.text = text
         self.response_type = "solution"
@@ -89,26 +101,83 @@ class SolutionResponse(BaseResponse):
 
 
 class TextCompleter:
-    def __init__(self, llm):
+    def __init__(self, llm, stop_sequences=None):
         self.llm = llm
-        self.on_token = lambda token: token
+        # optional callback receiving every generated token
+        self.on_token = None
 
-    def __call__(self, input_text):
-        raw_response = ""
+        # generation is cut off as soon as any of these strings is produced
+        self.stop_sequences = stop_sequences or []
 
-        for token in self.llm(input_text):
-            messenger.publish(TokenArrivedEvent(token))
-            self.on_token(token)
-            raw_response += token
+        # stop sequence that ended the last generation, if any
+        self.stopped_on = None
 
-        event_data = (raw_response, self.llm.response_data)
-        messenger.publish(GenerationCompleteEvent(event_data))
+        # prompt length per token, refined whenever the backend reports the prompt size
+        self.chars_per_token = 4
 
-        if hasattr(self.llm, "response_data") and self.llm.response_data.get("truncated"):
+    def __call__(self, input_text):
+        self.stopped_on = None
+        chunks = []
+        on_token = self.on_token
+
+        # end of the text generated so far that may hold the beginning of a stop sequence
+        tail = ""
+        tail_length = max((len(seq) for seq in self.stop_sequences), default=1) - 1
+
+        # checked once per generation, so that no event is created per token when nobody listens
+        publish_tokens = messenger.has_subscribers(TokenArrivedEvent.etype)
+
+        token_stream = self.llm(input_text)
+        for token in token_stream:
+            if publish_tokens:
+                messenger.publish(TokenArrivedEvent(token))
+            if on_token is not None:
+                on_token(token)
+            chunks.append(token)
+
+            if self.stop_sequences:
+                window = tail + token
+                self.stopped_on = self._find_stop_sequence(window, token)
+                if self.stopped_on is not None:
+                    self._close(token_stream)
+                    break
+                tail = window[max(0, len(window) - tail_length):]
+
+        raw_response = "".join(chunks)
+
+        response_data = self._complete_response_data(input_text)
+        messenger.publish(GenerationCompleteEvent((raw_response, response_data)))
+
+        if response_data.get("truncated"):
             raise RunOutOfContextError("LLM failed generating response: ran out of context")
 
         return raw_response
 
+    def _complete_response_data(self, input_text):
+        response_data = getattr(self.llm, "response_data", {})
+        n_evaluated = response_data.get("tokens_evaluated")
+        if n_evaluated is None:
+            # final stats never arrive when the stream is closed early on a stop sequence
+            estimate = int(len(input_text) / self.chars_per_token) + 1
+            return dict(response_data, tokens_evaluated=estimate)
+
+        if n_evaluated > 0:
+            self.chars_per_token = len(input_text) / n_evaluated
+        return response_data
+
+    def _find_stop_sequence(self, text, token):
+        for seq in self.stop_sequences:
+            # only the tail that could contain a newly completed sequence is searched
+            if seq in text[-(len(seq) + len(token)):]:
+                return seq
+        return None
+
+    def _close(self, token_stream):
+        # closing a generator releases the underlying connection, aborting generation
+        close = getattr(token_stream, "close", None)
+        if close:
+            close()
+
 
 class RunOutOfContextError(Exception):
     pass
@@ -126,9 +195,5 @@ class ToolUseError(Exception):
     pass
 
 
-class InvalidJsonError(Exception):
-    pass
-
-
 class BadToolUseError(Exception):
     pass
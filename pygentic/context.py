@@ -0,0 +1,72 @@
+from .messages import group_messages
+
+
+def estimate_tokens(text):
+    """Rough token count of a text (about 4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+class ContextManager:
+    """Decides which part of the chat history is sent to the LLM.
+
+    "start" is the index of the system message of the current call: history of an agent
+    that was called several times holds the messages of its earlier calls before it.
+    """
+    def __call__(self, messages, start=0):
+        return messages
+
+
+class TruncatingContextManager(ContextManager):
+    """Drops the oldest messages once history no longer fits into a token budget.
+
+    The first "num_pinned" messages of the current call (system message and the task
+    prompt) are always kept. Messages of earlier calls are dropped first, then the oldest
+    messages of the current call. Messages are dropped in groups of consecutive messages
+    of the same role, so that a tool call is never separated from its result.
+    """
+    def __init__(self, max_tokens, count_tokens=None, num_pinned=2):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+        self.num_pinned = num_pinned
+
+        # pairs of (message, size) counted on the previous call
+        self.counted = []
+
+    def __call__(self, messages, start=0):
+        sizes = self._count(messages)
+        total = sum(sizes)
+        if total <= self.max_tokens:
+            return messages
+
+        end = start + self.num_pinned
+        earlier, total = self._drop_oldest(messages[:start], sizes[:start], total, keep_last=False)
+        rest, _ = self._drop_oldest(messages[end:], sizes[end:], total, keep_last=True)
+        return earlier + messages[start:end] + rest
+
+    def _drop_oldest(self, messages, sizes, total, keep_last):
+        groups = list(group_messages(messages))
+        if keep_last:
+            groups = groups[:-1]
+
+        start = 0
+        for group in groups:
+            if total <= self.max_tokens:
+                break
+            total -= sum(sizes[start:start + len(group)])
+            start += len(group)
+
+        return messages[start:], total
+
+    def _count(self, messages):
+        # messages are compared by identity: history only grows between rounds, so
+        # all but the new messages were counted on the previous call
+        counted = {id(msg): (msg, size) for msg, size in self.counted}
+        sizes = []
+        for msg in messages:
+            cached_msg, size = counted.get(id(msg), (None, None))
+            if cached_msg is not msg:
+                size = self.count_tokens(msg.content.render())
+            sizes.append(size)
+
+        self.counted = list(zip(messages, sizes))
+        return sizes
@@ -1,5 +1,7 @@
 from jinja2 import Environment, PackageLoader, select_autoescape
 env = Environment(
     loader=PackageLoader("pygentic"),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    # templates ship with the package, so there is no need to stat them on every lookup
+    auto_reload=False
 )
\ No newline at end of file
@@ -1,21 +1,36 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import time
+import queue
+import threading
+import hashlib
+from collections import OrderedDict
 from dataclasses import dataclass
+from . import serialization
 
 
 class RequestMaker:
-    def __init__(self, proxies=None):
+    def __init__(self, proxies=None, pool_size=10):
         self.proxies = proxies or {}
 
+        # a session keeps connections alive between requests instead of reconnecting every time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
     def get(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.get(*args, **kwargs)
+        return self.session.get(*args, **kwargs)
 
     def post(self, *args, **kwargs):
         if self.proxies:
             kwargs["proxies"] = self.proxies
-        return requests.post(*args, **kwargs)
+        return self.session.post(*args, **kwargs)
+
+    def close(self):
+        self.session.close()
 
 
 class BaseLLM:
@@ -29,8 +44,80 @@ class BaseLLM:
         self.logger = logger
 
 
+class ResponseCache:
+    """Exact-match cache of LLM responses keyed by a digest of the prompt.
+
+    Entries expire after "ttl" seconds; the least recently used entry is evicted
+    once the cache holds "max_size" entries.
+    """
+    def __init__(self, ttl=3600, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # the cache may be shared by agents running in different threads
+        self.lock = threading.Lock()
+
+    def make_key(self, text, namespace=""):
+        # the namespace is hashed in full (a blake2b key would cut it to 64 bytes), and its
+        # fixed-size digest keeps the boundary between namespace and text unambiguous
+        digest = hashlib.blake2b(hashlib.blake2b(namespace.encode('utf-8')).digest(), digest_size=16)
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total if total else 0.0
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries), "hit_rate": hit_rate}
+
+
+def is_deterministic(llm):
+    """Returns True if llm is configured for greedy (temperature 0) sampling"""
+    spec = getattr(llm, 'generation_spec', None)
+    if spec is None:
+        return False
+    sampling_config = spec.sampling_config or {}
+    return float(sampling_config.get('temperature', 1)) <= 0
+
+
 class LlamaCpp(BaseLLM):
-    def __init__(self, base_url, generation_spec, proxies=None):
+    def __init__(self, base_url, generation_spec, proxies=None, cache=None):
         super().__init__()
         self.base_url = base_url
 
@@ -40,53 +127,134 @@ class LlamaCpp(BaseLLM):
 
         self.headers = {'Content-Type': 'application/json'}
 
-        self.response_data = {}
+        # stats of the last response are kept per thread, so that concurrent agents
+        # sharing this backend each see the stats of their own generation
+        self.local = threading.local()
+        self.cache = cache
+
+    @property
+    def response_data(self):
+        return getattr(self.local, "response_data", {})
+
+    @response_data.setter
+    def response_data(self, value):
+        self.local.response_data = value
 
     def __call__(self, prompt):
         sampling_config = self.generation_spec.sampling_config or {}
 
         clean_llm_settings(sampling_config)
 
-        yield from self.stream_response(prompt, sampling_config)
+        if self.cache is None or not is_deterministic(self):
+            yield from self.stream_response(prompt, sampling_config)
+            return
+
+        key = self.cache.make_key(prompt, self.cache_namespace(sampling_config))
+        cached = self.cache.get(key)
+        if cached is not None:
+            text, response_data = cached
+            # nothing was evaluated by the server on a cache hit
+            self.response_data = dict(response_data, tokens_evaluated=0)
+            yield text
+            return
+
+        tokens = []
+        for token in self.stream_response(prompt, sampling_config):
+            tokens.append(token)
+            yield token
+
+        if not self.response_data.get("truncated"):
+            self.cache.put(key, ("".join(tokens), self.response_data))
+
+    def close(self):
+        self.request_maker.close()
+
+    def cache_namespace(self, sampling_config=None):
+        if sampling_config is None:
+            sampling_config = self.generation_spec.sampling_config or {}
+        settings = serialization.canonical_dumps(sampling_config)
+        stop = serialization.dumps(self.stop_list())
+        return f'{self.base_url}|{stop}|{settings}'
+
+    def stop_list(self):
+        return [self.generation_spec.stop_word] + list(self.generation_spec.stop_sequences or [])
 
     def stream_response(self, prompt, sampling_settings):
         stop_word = self.generation_spec.stop_word
         resp = self.start_streaming(prompt, sampling_settings, stop_word)
-        line_gen = resp.iter_lines(chunk_size=1)
 
-        for line in self.skip_empty(line_gen):
-            entry = self.parse_line(line)
+        # with chunked transfer encoding (which llama.cpp uses for streaming) a read returns as
+        # soon as a chunk arrives; otherwise it blocks until filled, so bytes are read one by one
+        chunk_size = 8192 if getattr(resp.raw, "chunked", False) else 1
+        line_gen = resp.iter_lines(chunk_size=chunk_size)
+
+        try:
+            for line in self.skip_empty(line_gen):
+                entry = self.parse_line(line)
 
-            should_stop = entry["stop"] and entry["stopping_word"]
-            value = stop_word if should_stop else entry["content"]
-            self.response_data = entry
-            yield value
+                should_stop = entry["stop"] and entry["stopping_word"]
+                value = entry["stopping_word"] if should_stop else entry["content"]
+                self.response_data = entry
+                yield value
 
-            if should_stop:
-                break
+                if should_stop:
+                    break
+        finally:
+            resp.close()
 
     def start_streaming(self, prompt, sampling_settings, stop_word):
         url = f"{self.base_url}/completion"
 
-        payload = {"prompt": prompt, "stream": True, "stop": [stop_word], "cache_prompt": True}
+        # no slot is pinned: the server picks the slot whose cached prompt is most similar, so
+        # agents sharing this backend keep reusing their own prefixes instead of evicting each other's
+        payload = {"prompt": prompt, "stream": True, "stop": self.stop_list(), "cache_prompt": True}
         payload.update(sampling_settings)
 
-        return self.request_maker.post(url, data=json.dumps(payload), 
+        return self.request_maker.post(url, data=serialization.dumps_bytes(payload),
                                        headers=self.headers, stream=True)
 
     def skip_empty(self, line_generator):
         return (line for line in line_generator if line)
 
     def parse_line(self, line):
-        line = line.decode('utf-8')
+        # lines look like b'data: {...}'; JSON is decoded straight from bytes
         stripped_line = line[6:]
-        return json.loads(stripped_line)
+        return serialization.loads(stripped_line)
+
+
+class LLMPool(BaseLLM):
+    """Shares a fixed number of LLM backends between concurrent callers.
+
+    The pool size should match the number of server slots (e.g. llama.cpp started with
+    "--parallel n"), so that requests of concurrent agents are decoded by the server
+    in one batch, while extra callers wait in a queue instead of overloading it.
+    """
+    def __init__(self, create_llm, size):
+        super().__init__()
+        self.backends = queue.LifoQueue()
+        for _ in range(size):
+            self.backends.put(create_llm())
+
+        self.local = threading.local()
+
+    @property
+    def response_data(self):
+        return getattr(self.local, "response_data", {})
+
+    def __call__(self, prompt):
+        llm = self.backends.get()
+        try:
+            yield from llm(prompt)
+        finally:
+            self.local.response_data = llm.response_data
+            self.backends.put(llm)
 
 
 @dataclass
 class GenerationSpec:
     sampling_config: dict
     stop_word: str = None
+    stop_sequences: list = None
 
     def to_dict(self):
         return self.__dict__
@@ -55,13 +55,7 @@ class PlainTextLoader(FileLoader):
 class SimplePdfLoader(FileLoader):
     def process_file(self, path):
         reader = PdfReader(path)
-        number_of_pages = len(reader.pages)
-        content = ""
-
-        for i in range(number_of_pages):
-            page = reader.pages[i]
-            content += page.extract_text()
-        return content
+        return "".join(page.extract_text() for page in reader.pages)
 
 
 @dataclass
@@ -102,8 +96,7 @@ class FileTreeLoader:
         else:
             for name in os.listdir(path):
                 sub_path = os.path.join(path, name)
-                loader = FileTreeLoader(self.config, self.message_factory)
-                sections.extend(loader(sub_path))
+                sections.extend(self(sub_path))
 
         return sections
 
@@ -1,10 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Union, List, Any
 from .jinja_env import env
-from .tool_calling import SimpleTagBasedToolUse
+from .tool_calling import default_tool_use_backend
 
 
 class Modality:
+    __slots__ = ()
+
     def render(self):
         raise NotImplemented
 
@@ -15,6 +17,8 @@ class Modality:
 
 @dataclass
 class TextModality(Modality):
+    __slots__ = ('data',)
+
     data: str
 
     def render(self):
@@ -23,6 +27,8 @@ class TextModality(Modality):
 
 @dataclass
 class ImageModality(Modality):
+    __slots__ = ('data', 'mime_type', 'width', 'height')
+
     data: bytes
     mime_type: str
     width: int
@@ -34,13 +40,19 @@ class ToolCall(Modality):
     name: str
     arg_dict: dict
     renderer: callable
+    rendered: str = field(default=None, init=False, repr=False, compare=False)
 
     def render(self):
-        return self.renderer(self.name, self.arg_dict)
+        # serialized once; the same message is rendered for the log, the prompt and token counting
+        if self.rendered is None:
+            self.rendered = self.renderer(self.name, self.arg_dict)
+        return self.rendered
 
 
 @dataclass
 class RawToolCall(Modality):
+    __slots__ = ('syntax', 'renderer')
+
     syntax: str
     renderer: callable
 
@@ -53,9 +65,12 @@ class ToolResult(Modality):
     name: str
     result: Any
     renderer: callable
+    rendered: str = field(default=None, init=False, repr=False, compare=False)
 
     def render(self):
-        return self.renderer(self.name, self.result)
+        if self.rendered is None:
+            self.rendered = self.renderer(self.name, self.result)
+        return self.rendered
 
 
 @dataclass
@@ -63,13 +78,18 @@ class ToolError(Modality):
     name: str
     error: str
     renderer: callable
+    rendered: str = field(default=None, init=False, repr=False, compare=False)
 
     def render(self):
-        return self.renderer(self.name, self.error)
+        if self.rendered is None:
+            self.rendered = self.renderer(self.name, self.error)
+        return self.rendered
 
 
 @dataclass
 class ToolParseError(Modality):
+    __slots__ = ('error', 'renderer')
+
     error: str
     renderer: callable
 
@@ -79,6 +99,8 @@ class ToolParseError(Modality):
 
 @dataclass
 class CompositeModality(Modality):
+    __slots__ = ('layout', 'items')
+
     layout: str
     items: List[Modality]
 
@@ -92,6 +114,8 @@ class CompositeModality(Modality):
 
 @dataclass
 class Message:
+    __slots__ = ('role', 'content')
+
     role: str
     content: Union[TextModality, ImageModality, ToolCall, ToolResult, CompositeModality]
 
@@ -126,10 +150,11 @@ class JinjaChatFactory(ChatFactory):
     def __init__(self, arch, tool_use):
         self.arch = arch
         self.tool_use = tool_use
+        self._template = None
         
         if not tool_use:
             if arch == 'llama3':
-                self.tool_use = SimpleTagBasedToolUse.create_default()
+                self.tool_use = default_tool_use_backend()
             else:
                 raise Exception("Cannot find tool use backend")
 
@@ -176,13 +201,78 @@ class JinjaChatFactory(ChatFactory):
                 collate_fn = collate_fn or collate
                 messages = [collate_fn(group) for group in group_messages(messages)]
 
+            return self.template.render(messages=messages) + self.generation_prompt
+
+        return render
+
+    def get_incremental_chat_renderer(self):
+        return IncrementalChatRenderer(self.template, self.generation_prompt)
+
+    @property
+    def template(self):
+        if self._template is None:
             if self.arch == 'llama3':
-                template = env.get_template('llama_3.jinja')
-                return template.render(messages=messages) + '<|start_header_id|>assistant<|end_header_id|>'
+                self._template = env.get_template('llama_3.jinja')
             else:
                 raise Exception("Cannot find jinja template to render chat")
+        return self._template
 
-        return render
+    @property
+    def generation_prompt(self):
+        return '<|start_header_id|>assistant<|end_header_id|>'
+
+
+class IncrementalChatRenderer:
+    """Renders a chat reusing text rendered for the same messages on previous calls.
+
+    Messages are grouped by role and every group is rendered separately, so only groups
+    that changed since the last call are passed to the template. This assumes the
+    template renders each message independently of the others (e.g. a plain loop over
+    messages), which is the case for the bundled templates.
+    """
+    def __init__(self, template, generation_prompt='', collate_fn=None):
+        self.template = template
+        self.generation_prompt = generation_prompt
+        self.collate_fn = collate_fn or collate
+
+        # text emitted by the template regardless of messages (e.g. BOS token)
+        self.head = template.render(messages=[])
+
+        # pairs of (group of messages, rendered text of the group)
+        self.rendered_groups = []
+
+    def __call__(self, messages):
+        groups = list(group_messages(messages))
+
+        n = 0
+        for group, (cached_group, _) in zip(groups, self.rendered_groups):
+            if not same_messages(group, cached_group):
+                break
+            n += 1
+
+        rendered_groups = self.rendered_groups[:n]
+        for group in groups[n:]:
+            rendered_groups.append((group, self._render_group(group)))
+
+        self.rendered_groups = rendered_groups
+        body = ''.join(text for _, text in rendered_groups)
+        return self.head + body + self.generation_prompt
+
+    def clone(self):
+        """Returns an independent renderer that starts with the text rendered so far"""
+        renderer = IncrementalChatRenderer(self.template, self.generation_prompt, self.collate_fn)
+        renderer.rendered_groups = self.rendered_groups[:]
+        return renderer
+
+    def _render_group(self, group):
+        text = self.template.render(messages=[self.collate_fn(group)])
+        return text[len(self.head):] if text.startswith(self.head) else text
+
+
+def same_messages(messages, other_messages):
+    if len(messages) != len(other_messages):
+        return False
+    return all(msg is other for msg, other in zip(messages, other_messages))
 
 
 def group_messages(messages):
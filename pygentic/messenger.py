@@ -5,14 +5,27 @@ class Messenger:
     def subscribe(self, event_type, callable):
         self.subscribers.setdefault(event_type, []).append(callable)
 
+    def unsubscribe(self, event_type, callable):
+        receivers = self.subscribers.get(event_type, [])
+        if callable in receivers:
+            receivers.remove(callable)
+        if not receivers:
+            self.subscribers.pop(event_type, None)
+
     def publish(self, event):
-        etype = event.etype
-        receivers = self.subscribers.get(etype, [])
-        for callable in receivers:
-            callable(event.data)
+        receivers = self.subscribers.get(event.etype)
+        if receivers:
+            for callable in receivers:
+                callable(event.data)
+
+    def has_subscribers(self, event_type):
+        return bool(self.subscribers.get(event_type))
 
 
 class Event:
+    # events are created for every generated token
+    __slots__ = ("data",)
+
     etype = "generic"
 
     def __init__(self, data):
@@ -20,10 +33,14 @@ class Event:
 
 
 class TokenArrivedEvent(Event):
+    __slots__ = ()
+
     etype = "token_arrived"
 
 
 class GenerationCompleteEvent(Event):
+    __slots__ = ()
+
     etype = "generation_complete"
 
 
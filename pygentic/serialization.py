@@ -0,0 +1,40 @@
+"""JSON helpers used on the tool calling path.
+
+orjson is used when it is installed; otherwise the standard library json module
+produces identical (compact, UTF-8) output.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+def dumps_bytes(data):
+    """Serializes data to UTF-8 encoded JSON, e.g. for a request body"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def canonical_dumps(data):
+    """Serializes data with sorted keys, so that equal dicts produce equal strings"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
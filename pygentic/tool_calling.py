@@ -1,18 +1,43 @@
 import re
-import json
+import string
 from dataclasses import dataclass
+from functools import lru_cache
 from inspect import signature
 from .chat_render import ChatRendererToString, default_template
 from .jinja_env import env
+from . import serialization
+
+
+TOOL_USE_START = "<|tool_use_start|>"
+TOOL_USE_END = "<|tool_use_end|>"
+RESULT_START = "<|result_start|>"
+RESULT_END = "<|result_end|>"
+ERROR_START = "<|error_start|>"
+ERROR_END = "<|error_end|>"
+
+
+def scan_tool_use(s, start_tag=TOOL_USE_START, end_tag=TOOL_USE_END):
+    """Returns (offset, length, body) of the first tool use enclosed in the tags or None.
+
+    The tags are literal strings, so plain substring search is used instead of a regex.
+    """
+    start = s.find(start_tag)
+    if start < 0:
+        return None
+
+    body_start = start + len(start_tag)
+    end = s.find(end_tag, body_start)
+    if end < 0:
+        return None
+
+    return start, end + len(end_tag) - start, s[body_start:end]
 
 
 def find_tool_use(s):
-    pattern = r"\<\|tool_use_start\|\>([^<]*)<\|tool_use_end\|>"
-    match = re.search(pattern, s)
-    if match:
-        return match.start(), len(match.group(0)), match.group(1)
-    else:
+    match = scan_tool_use(s)
+    if match is None:
         raise ToolUseNotFoundError("Tool use not found")
+    return match
 
 
 class ToolUseNotFoundError(Exception):
@@ -20,50 +45,109 @@ class ToolUseNotFoundError(Exception):
 
 
 def contains_tool_use(s):
-    try:
-        find_tool_use(s)
-        return True
-    except ToolUseNotFoundError:
-        return False
+    return scan_tool_use(s) is not None
 
 
 def parse_tool_use(text):
+    result, error = try_parse_tool_use(text)
+    if error:
+        raise ValueError(error)
+    return result
+
+
+def try_parse_tool_use(text):
+    """Returns ((tool_name, arg_dict), None) for a valid tool call, otherwise (None, error message)"""
     try:
-        data = json.loads(text)
-        if 'tool_name' in data:
-            return (data['tool_name'], data.get('args', {}))
-        else:
-            raise ValueError("Tool name not found in JSON string")
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON string: {e}")
+        data = serialization.loads(text)
+    except serialization.JSONDecodeError as e:
+        return None, f"Invalid JSON string: {e}"
+    return check_tool_use(data)
+
+
+def validate_tool_use(data):
+    """Checks that decoded JSON has the shape {"tool_name": str, "args": dict} and returns both fields"""
+    result, error = check_tool_use(data)
+    if error:
+        raise ValueError(error)
+    return result
+
+
+def check_tool_use(data):
+    if not isinstance(data, dict) or 'tool_name' not in data:
+        return None, "Tool name not found in JSON string"
+
+    tool_name = data['tool_name']
+    if not isinstance(tool_name, str):
+        return None, "Tool name must be a string"
+
+    args = data.get('args')
+    if args is None:
+        args = {}
+    elif not isinstance(args, dict):
+        return None, "Tool arguments must be a JSON object"
+    return (tool_name, args), None
 
 
 def render_tool_use_string(tool_name, arg_dict, result=None):
     data = {'tool_name': tool_name, 'args': arg_dict}
     result = result or ''
-    return f'<|tool_use_start|>{json.dumps(data)}<|tool_use_end|><|result_start|>{result}<|result_end|>'
+    return f'{TOOL_USE_START}{serialization.dumps(data)}{TOOL_USE_END}{RESULT_START}{result}{RESULT_END}'
 
 
 def render_tool_use_error(tool_name, arg_dict, error=None):
     data = {'tool_name': tool_name, 'args': arg_dict}
     error = error or ''
-    return f'<|tool_use_start|>{json.dumps(data)}<|tool_use_end|><|error_start|>{error}<|error_end|>'
+    return f'{TOOL_USE_START}{serialization.dumps(data)}{TOOL_USE_END}{ERROR_START}{error}{ERROR_END}'
+
+
+def compile_template(template):
+    """Returns a function substituting a value into a str.format template with a single "{}" field.
+
+    The template is split around the field once, so that filling it is a plain concatenation
+    instead of parsing the format string on every call. Other templates fall back to str.format.
+    """
+    prefix = []
+    suffix = []
+    num_fields = 0
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        (suffix if num_fields else prefix).append(literal)
+        if field_name is not None:
+            if num_fields or field_name not in ('', '0') or format_spec or conversion:
+                return template.format
+            num_fields += 1
+
+    if num_fields != 1:
+        return template.format
+
+    prefix = ''.join(prefix)
+    suffix = ''.join(suffix)
+    return lambda value: f'{prefix}{value}{suffix}'
 
 
 class ToolUse:
     def find(self, s):
+        match = self.search(s)
+        if match is None:
+            raise ToolUseNotFoundError("Tool use not found")
+        return match
+
+    def search(self, s):
+        """Returns (offset, length, body) of the first tool use in s or None if there is none"""
         raise NotImplementedError
 
     def contains_tool_use(self, s):
-        try:
-            self.find(s)
-            return True
-        except ToolUseNotFoundError:
-            return False
+        return self.search(s) is not None
 
     def parse(self, text):
         raise NotImplementedError
 
+    def try_parse(self, text):
+        """Like parse, but returns ((tool_name, arg_dict), None) or (None, error message) instead of raising"""
+        try:
+            return self.parse(text), None
+        except ValueError as e:
+            return None, str(e)
+
     def render_tool_call(self, tool_name, arg_dict):
         raise NotImplementedError
 
@@ -88,55 +172,51 @@ class GenericToolUse(ToolUse):
     error_template: str
     syntax_error_template: str = ""
 
-    def find(self, s):
-        pattern = self.test
-        match = re.search(pattern, s)
+    def __post_init__(self):
+        self.regex = re.compile(self.test)
+
+        self.fill_call = compile_template(self.call_template)
+        self.fill_success = compile_template(self.success_template)
+        self.fill_error = compile_template(self.error_template)
+        self.fill_syntax_error = compile_template(self.syntax_error_template)
+
+    def search(self, s):
+        match = self.regex.search(s)
         if match:
             return match.start(), len(match.group(0)), match.group(1)
-        else:
-            raise ToolUseNotFoundError("Tool use not found")
+        return None
 
     def parse(self, text):
-        try:
-            data = json.loads(text)
-            if 'tool_name' in data:
-                return (data['tool_name'], data.get('args', {}))
-            else:
-                raise ValueError("Tool name not found in JSON string")
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Invalid JSON string: {e}")
+        return parse_tool_use(text)
+
+    def try_parse(self, text):
+        return try_parse_tool_use(text)
 
     def render_tool_call(self, tool_name, arg_dict):
         data = {'tool_name': tool_name, 'args': arg_dict}
-        body = json.dumps(data)
-        return self.call_template.format(body)
+        body = serialization.dumps(data)
+        return self.fill_call(body)
 
     def render_raw_tool_call(self, body):
-        return self.call_template.format(body)
+        return self.fill_call(body)
 
     def render_result(self, tool_name, result):
         data = {'tool_name': tool_name, 'result': result}
-        body = json.dumps(data)
-        return self.success_template.format(body)
+        body = serialization.dumps(data)
+        return self.fill_success(body)
 
     def render_error(self, tool_name, error):
         data = {'tool_name': tool_name, 'error': error}
-        body = json.dumps(data)
-        return self.error_template.format(body)
+        body = serialization.dumps(data)
+        return self.fill_error(body)
 
     def render_syntax_error(self, error):
-        return self.syntax_error_template.format(error)
+        return self.fill_syntax_error(error)
 
 
 class SimpleTagBasedToolUse(GenericToolUse):
     def __init__(self, start_tag, end_tag, result_start_tag, result_end_tag,
                  error_start_tag, error_end_tag):
-        def escape(s):
-            escape_chars = '<|>'
-            for ch in escape_chars:
-                s = s.replace(ch, "\\" + ch)
-            return s
-
         call_template = f'{start_tag}{{}}{end_tag}'
         success_template = f'{result_start_tag}{{}}{result_end_tag}'
         error_template = f'{error_start_tag}{{}}{error_end_tag}'
@@ -145,35 +225,72 @@ class SimpleTagBasedToolUse(GenericToolUse):
         self.start_tag = start_tag
         self.end_tag = end_tag
 
-        start_tag = escape(start_tag)
-        end_tag = escape(end_tag)
-        error_start_tag = escape(error_start_tag)
-        error_end_tag = escape(error_end_tag)
-
-        test = f"{start_tag}([^<]*){end_tag}"
+        test = f"{re.escape(start_tag)}((?s:.*?)){re.escape(end_tag)}"
         super().__init__(test, call_template, success_template, error_template, syntax_error_template)
 
+    def search(self, s):
+        return scan_tool_use(s, self.start_tag, self.end_tag)
+
     @classmethod
     def create_default(cls):
-        return cls(start_tag="<|tool_use_start|>",
-                   end_tag="<|tool_use_end|>",
-                   result_start_tag="<|result_start|>",
-                   result_end_tag="<|result_end|>",
-                   error_start_tag="<|error_start|>",
-                   error_end_tag="<|error_end|>")
+        return cls(start_tag=TOOL_USE_START,
+                   end_tag=TOOL_USE_END,
+                   result_start_tag=RESULT_START,
+                   result_end_tag=RESULT_END,
+                   error_start_tag=ERROR_START,
+                   error_end_tag=ERROR_END)
 
     def parse(self, text):
-        try:
-            return super().parse(text)
-        except ValueError as e:
-            text += '}'
-            print("Value error, trying to recover with body:", text)
-            # todo: even more robust behaviour, auto-correct more errors
-            # todo: consider to use custom recovery strategies for fixing simple cases
-            try:
-                return super().parse(text)
-            except:
-                raise e
+        result, error = self.try_parse(text)
+        if error:
+            raise ValueError(error)
+        return result
+
+    def try_parse(self, text):
+        result, error = super().try_parse(text)
+        if error is None:
+            return result, None
+
+        fixed_text = close_json(text)
+        if fixed_text == text:
+            return None, error
+
+        print("Value error, trying to recover with body:", fixed_text)
+        # todo: even more robust behaviour, auto-correct more errors
+        fixed_result, fixed_error = super().try_parse(fixed_text)
+        if fixed_error is None:
+            return fixed_result, None
+        return None, error
+
+
+def close_json(text):
+    """Appends the quote and brackets left open at the end of truncated JSON.
+
+    Text is returned unchanged when nothing is left open or brackets are mismatched.
+    """
+    closers = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            closers.append('}')
+        elif ch == '[':
+            closers.append(']')
+        elif ch in '}]':
+            if not closers or closers.pop() != ch:
+                return text
+
+    suffix = '"' if in_string else ''
+    return text + suffix + ''.join(reversed(closers))
 
 
 tool_registry = {}
@@ -197,5 +314,19 @@ def register(name=None):
     return decorator
 
 
+def cacheable(ttl=3600):
+    """Marks a tool without side effects, so that its results can be reused for the same arguments"""
+    def decorator(func):
+        func.cache_ttl = ttl
+        return func
+
+    return decorator
+
+
+@lru_cache(maxsize=None)
 def default_tool_use_backend():
+    """Returns a tool use backend shared by everything using the default tags.
+
+    Backends hold no per-conversation state, so there is no need to build one per agent.
+    """
     return SimpleTagBasedToolUse.create_default()
@@ -1,16 +1,16 @@
 import argparse
 import os
+import sys
 import importlib
 from inspect import signature
 from pygentic.misc import load_yaml
-from pygentic.llm_backends import GenerationSpec, LlamaCpp
-from pygentic import FileOutputDevice, Agent, FileLoadingConfig
-from pygentic import run_agent
+from pygentic.llm_backends import GenerationSpec, LlamaCpp, LLMPool
+from pygentic import FileOutputDevice, Agent, FileLoadingConfig, TruncatingContextManager
+from pygentic import run_agent, BudgetExceededError
 from pygentic.loaders import get_default_loaders
 from pygentic.tool_calling import default_tool_use_backend, tool_registry
 from pygentic.jinja_env import env
 from pygentic.messages import JinjaChatFactory
-from pygentic.tool_calling import SimpleTagBasedToolUse
 
 
 def build_llamacpp(spec):
@@ -18,9 +18,16 @@ def build_llamacpp(spec):
     sampling_config = spec['sampling_config']
     stop_token = spec['stop_token']
     proxies = spec.get('proxies', None)
+    stop_sequences = spec.get('stop_sequences', None)
 
     generation_spec = GenerationSpec(sampling_config=sampling_config,
-                                     stop_word=stop_token)
+                                     stop_word=stop_token,
+                                     stop_sequences=stop_sequences)
+
+    # number of server slots that may be used concurrently
+    parallel = spec.get('parallel', 1)
+    if parallel > 1:
+        return LLMPool(lambda: LlamaCpp(base_url, generation_spec, proxies=proxies), parallel)
 
     return LlamaCpp(base_url, generation_spec, proxies=proxies)
 
@@ -137,14 +144,18 @@ def build_agents(spec, llms, tool_use_backend):
             raise ValueError(f'LLM "{llm_name}" not found in the YAML specification')
         llm = llms[llm_name]
 
-        agent = Agent(llm, chosen_tools, system_message=system_message, max_rounds=max_rounds, output_device=output_device)
+        max_context_tokens = agent_spec.get('max_context_tokens')
+        context_manager = TruncatingContextManager(max_context_tokens) if max_context_tokens else None
+
+        agent = Agent(llm, chosen_tools, system_message=system_message, max_rounds=max_rounds,
+                      output_device=output_device, context_manager=context_manager)
         agents[agent_name] = agent
     return agents
 
 
 def get_loading_conf(spec):
     """Override default loaders by custom ones when provided"""
-    tool_use = SimpleTagBasedToolUse.create_default()
+    tool_use = default_tool_use_backend()
 
     message_factory = JinjaChatFactory('llama3', tool_use)
     loaders = get_default_loaders(message_factory)
@@ -234,5 +245,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     yaml_file_path = args.yaml_file
-    result = main(yaml_file_path)
+    try:
+        result = main(yaml_file_path)
+    except BudgetExceededError as e:
+        print(f'Aborted the script. {e}')
+        sys.exit(1)
     print(f'Program successfully finished with result: {result}')
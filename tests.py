@@ -1,5 +1,7 @@
+import sys
 import unittest
 import json
+import threading
 from unittest.mock import Mock
 from pygentic import (
     ToolUseNotFoundError, find_tool_use, parse_tool_use, render_tool_use_string,
@@ -91,6 +93,13 @@ class FindToolUseTests(unittest.TestCase):
         self.assertEqual(length, len(tool_use_str))
         self.assertEqual(body, "[abc] {def} ")
 
+    def test_angle_brackets(self):
+        tool_use_str = '<|tool_use_start|>{"text": "a < b"}<|tool_use_end|>'
+        offset, length, body = find_tool_use(tool_use_str)
+        self.assertEqual(offset, 0)
+        self.assertEqual(length, len(tool_use_str))
+        self.assertEqual(body, '{"text": "a < b"}')
+
 
 class TestParseToolUse(unittest.TestCase):
 
@@ -133,6 +142,22 @@ class TestParseToolUse(unittest.TestCase):
         self.assertEqual(tool_name, "my_tool")
         self.assertEqual(args, {"arg1": True})
 
+    def test_non_object_json(self):
+        for text in ['"tool_name"', '["tool_name"]', '123']:
+            with self.assertRaises(ValueError):
+                parse_tool_use(text)
+
+    def test_invalid_field_types(self):
+        with self.assertRaises(ValueError):
+            parse_tool_use('{"tool_name": 1, "args": {}}')
+
+        with self.assertRaises(ValueError):
+            parse_tool_use('{"tool_name": "my_tool", "args": [1, 2]}')
+
+    def test_missing_args(self):
+        self.assertEqual(("my_tool", {}), parse_tool_use('{"tool_name": "my_tool"}'))
+        self.assertEqual(("my_tool", {}), parse_tool_use('{"tool_name": "my_tool", "args": null}'))
+
     def test_find_and_parse_tool_use_with_valid_payload(self):
         tool_use_str = '<|tool_use_start|>{"tool_name": "my_tool", "args": {"arg1": 123}}<|tool_use_end|>'
         offset, length, body = find_tool_use(tool_use_str)
@@ -171,6 +196,67 @@ class RederToolUseString(unittest.TestCase):
         self.assertEqual(render_tool_use_string(tool_name, arg_dict, result), expected_output)
 
 
+from pygentic.tool_calling import compile_template, SimpleTagBasedToolUse, close_json
+from pygentic import serialization
+
+
+class CompileTemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.tool_use = SimpleTagBasedToolUse.create_default()
+
+    def assert_same_as_format(self, template, value):
+        self.assertEqual(template.format(value), compile_template(template)(value))
+
+    def test_matches_format(self):
+        self.assert_same_as_format('<|tool_use_start|>{}<|tool_use_end|>', '{"a": 1}')
+        self.assert_same_as_format('{}', 'value')
+        self.assert_same_as_format('{0} after', 'value')
+        self.assert_same_as_format('{{literal}} {} {{braces}}', 'value')
+
+    def test_falls_back_to_format(self):
+        self.assertEqual('a-b', compile_template('{}-{}')('a', 'b'))
+        self.assertEqual('  x', compile_template('{:>3}')('x'))
+        self.assertEqual('no fields', compile_template('no fields')())
+
+    def test_single_line_arguments(self):
+        arg_dict = {"op1": 4, "op2": 6, "operation": "+"}
+        body = serialization.dumps({'tool_name': 'calculator', 'args': arg_dict})
+        expected = self.tool_use.call_template.format(body)
+        self.assertEqual(expected, self.tool_use.render_tool_call('calculator', arg_dict))
+
+    def test_multi_line_arguments(self):
+        arg_dict = {"code": "def f():\n    return {}\n", "path": "a/b.py"}
+        body = serialization.dumps({'tool_name': 'write', 'args': arg_dict})
+        expected = self.tool_use.call_template.format(body)
+        self.assertEqual(expected, self.tool_use.render_tool_call('write', arg_dict))
+
+        raw_body = '{"tool_name": "write",\n "args": {"code": "line1\nline2"}}'
+        self.assertEqual(self.tool_use.call_template.format(raw_body), self.tool_use.render_raw_tool_call(raw_body))
+
+    def test_result_and_errors(self):
+        result_body = serialization.dumps({'tool_name': 'calculator', 'result': '{10}'})
+        self.assertEqual(self.tool_use.success_template.format(result_body),
+                         self.tool_use.render_result('calculator', '{10}'))
+
+        error_body = serialization.dumps({'tool_name': 'calculator', 'error': 'bad {x}'})
+        self.assertEqual(self.tool_use.error_template.format(error_body),
+                         self.tool_use.render_error('calculator', 'bad {x}'))
+
+        self.assertEqual(self.tool_use.syntax_error_template.format('oops {'),
+                         self.tool_use.render_syntax_error('oops {'))
+
+    def test_recovered_call_renders_like_format(self):
+        truncated = '{"tool_name": "my_tool",\n "args": {"text": "a", "items": [1, 2'
+        tool_name, arg_dict = self.tool_use.parse(truncated)
+        self.assertEqual({"text": "a", "items": [1, 2]}, arg_dict)
+
+        body = serialization.dumps({'tool_name': tool_name, 'args': arg_dict})
+        self.assertEqual(self.tool_use.call_template.format(body), self.tool_use.render_tool_call(tool_name, arg_dict))
+
+        fixed = close_json(truncated)
+        self.assertEqual(self.tool_use.call_template.format(fixed), self.tool_use.render_raw_tool_call(fixed))
+
+
 class TestAgent(unittest.TestCase):
 
     def setUp(self):
@@ -367,7 +453,8 @@ class TestChatRendererToString(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
 
-from pygentic import TextCache
+from pygentic import JinjaChatFactory, collate
+from pygentic import TextCache, ResponseCache, GeneratorWithRetries, TextCompleter, LlamaCpp, GenerationSpec
 
 
 class TextCacheTests(unittest.TestCase):
@@ -401,6 +488,826 @@ class TextCacheTests(unittest.TestCase):
         self.assertEqual("hello", cache("hello"))
         self.assertEqual("world", cache("world"))
 
+    def test_common_prefix_length(self):
+        from pygentic import get_common_prefix_length
+        self.assertEqual(0, get_common_prefix_length("", "abc"))
+        self.assertEqual(0, get_common_prefix_length("xbc", "abc"))
+        self.assertEqual(3, get_common_prefix_length("abc", "abcdef"))
+        self.assertEqual(4, get_common_prefix_length("abcdef", "abcd"))
+        for i in range(10):
+            self.assertEqual(i, get_common_prefix_length("a" * i + "x" + "b" * 5, "a" * 20))
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_miss_then_hit(self):
+        cache = ResponseCache()
+        key = cache.make_key("hello")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "world")
+        self.assertEqual("world", cache.get(key))
+        self.assertEqual(1, cache.stats()["hits"])
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def test_namespace_changes_key(self):
+        cache = ResponseCache()
+        self.assertNotEqual(cache.make_key("hello", "a"), cache.make_key("hello", "b"))
+
+    def test_long_namespaces_differing_at_end(self):
+        cache = ResponseCache()
+        prefix = "x" * 100
+        self.assertNotEqual(cache.make_key("hello", prefix + "a"), cache.make_key("hello", prefix + "b"))
+
+    def test_expired_entry(self):
+        cache = ResponseCache(ttl=-1)
+        key = cache.make_key("hello")
+        cache.put(key, "world")
+        self.assertIsNone(cache.get(key))
+
+    def test_eviction(self):
+        cache = ResponseCache(max_size=2)
+        for text in ["a", "b", "c"]:
+            cache.put(cache.make_key(text), text)
+        self.assertIsNone(cache.get(cache.make_key("a")))
+        self.assertEqual("c", cache.get(cache.make_key("c")))
+
+    class TextLLM(LlamaCpp):
+        def __init__(self, sampling_config, response="response"):
+            super().__init__("http://localhost:8080", GenerationSpec(sampling_config, "</s>"))
+            self.response = response
+            self.call_count = 0
+
+        def __call__(self, text):
+            self.call_count += 1
+            return self.response
+
+    def test_generator_with_retries_uses_cache(self):
+        llm = self.TextLLM({"temperature": 0})
+        generator = GeneratorWithRetries(llm, cache=ResponseCache())
+        self.assertEqual("response", generator("prompt"))
+        self.assertEqual("response", generator("prompt"))
+        self.assertEqual(1, llm.call_count)
+
+    def test_generator_with_retries_skips_cache_when_sampling(self):
+        llm = self.TextLLM({"temperature": 0.7})
+        generator = GeneratorWithRetries(llm, cache=ResponseCache())
+        generator("prompt")
+        generator("prompt")
+        self.assertEqual(2, llm.call_count)
+
+    def test_generator_with_retries_keys_cache_by_settings(self):
+        cache = ResponseCache()
+        first = GeneratorWithRetries(self.TextLLM({"temperature": 0, "top_k": 1}, "first"), cache=cache)
+        second = GeneratorWithRetries(self.TextLLM({"temperature": 0, "top_k": 40}, "second"), cache=cache)
+        self.assertEqual("first", first("prompt"))
+        self.assertEqual("second", second("prompt"))
+
+
+class GeneratorWithRetriesTests(unittest.TestCase):
+    def test_retries_until_success(self):
+        llm = Mock(side_effect=[Exception("error"), Exception("error"), "response"])
+        generator = GeneratorWithRetries(llm, max_retries=2)
+        self.assertEqual("response", generator("prompt"))
+        self.assertEqual(3, llm.call_count)
+
+    def test_gives_up_after_max_retries(self):
+        llm = Mock(side_effect=Exception("error"))
+        generator = GeneratorWithRetries(llm, max_retries=2)
+        self.assertRaises(Exception, generator, "prompt")
+        self.assertEqual(3, llm.call_count)
+
+    def test_many_retries_do_not_grow_the_stack(self):
+        retries = sys.getrecursionlimit() + 10
+        llm = Mock(side_effect=[Exception("error")] * retries + ["response"])
+        generator = GeneratorWithRetries(llm, max_retries=retries)
+        self.assertEqual("response", generator("prompt"))
+
+    def test_continuation_resends_prompt_with_partial_response(self):
+        llm = Mock(side_effect=["first", " second"])
+        generator = GeneratorWithRetries(llm, max_continue=1)
+        generator.incomplete_response = lambda text: text == "first"
+        self.assertEqual("first second", generator("prompt: "))
+        self.assertEqual(("prompt: first", ), llm.call_args.args)
+
+
+from pygentic import handle_delegate, RunOutOfContextError
+
+
+class HandleDelegateTests(unittest.TestCase):
+    def make_agent(self, sub_agent):
+        agent = Mock()
+        agent.sub_agents = {"sub": sub_agent}
+        return agent
+
+    def test_raises_last_error_after_retries(self):
+        sub_agent = Mock(side_effect=RunOutOfContextError("out of context"))
+        agent = self.make_agent(sub_agent)
+        self.assertRaises(RunOutOfContextError, handle_delegate, agent, {"name": "sub", "inputs": {}})
+        self.assertEqual(3, sub_agent.call_count)
+
+    def test_retries_until_success(self):
+        sub_agent = Mock(side_effect=[RunOutOfContextError("out of context"), "done"])
+        agent = self.make_agent(sub_agent)
+        self.assertEqual("done", handle_delegate(agent, {"name": "sub", "inputs": {}}))
+
+    def test_zero_retries_rejected(self):
+        agent = self.make_agent(Mock())
+        self.assertRaises(ValueError, handle_delegate, agent, {"name": "sub", "inputs": {}}, retries=0)
+
+
+class TextCompleterTests(unittest.TestCase):
+    class StreamingLLM:
+        def __init__(self, tokens):
+            self.tokens = tokens
+            self.response_data = {}
+            self.consumed = 0
+
+        def __call__(self, text):
+            for token in self.tokens:
+                self.consumed += 1
+                yield token
+
+    def test_without_stop_sequences(self):
+        llm = self.StreamingLLM(["a", "b", "c"])
+        self.assertEqual("abc", TextCompleter(llm)("prompt"))
+
+    def test_stops_after_stop_sequence(self):
+        llm = self.StreamingLLM(["text", "<|tool_use_", "end|>", "trailing", "tokens"])
+        completer = TextCompleter(llm, stop_sequences=["<|tool_use_end|>"])
+        self.assertEqual("text<|tool_use_end|>", completer("prompt"))
+        self.assertEqual(3, llm.consumed)
+
+    def test_stop_sequence_split_across_many_tokens(self):
+        llm = self.StreamingLLM(["a", "<|", "tool", "_use", "_end", "|", ">", "b"])
+        completer = TextCompleter(llm, stop_sequences=["<|tool_use_end|>", "###"])
+        self.assertEqual("a<|tool_use_end|>", completer("prompt"))
+        self.assertEqual("<|tool_use_end|>", completer.stopped_on)
+
+    def test_stopped_on_reset(self):
+        completer = TextCompleter(self.StreamingLLM(["a"]), stop_sequences=["###"])
+        completer.stopped_on = "###"
+        completer("prompt")
+        self.assertIsNone(completer.stopped_on)
+
+    def test_tokens_published_to_subscribers(self):
+        from pygentic.messenger import messenger, TokenArrivedEvent
+        received = []
+        messenger.subscribe(TokenArrivedEvent.etype, received.append)
+        try:
+            TextCompleter(self.StreamingLLM(["a", "b"]))("prompt")
+        finally:
+            messenger.unsubscribe(TokenArrivedEvent.etype, received.append)
+        self.assertEqual(["a", "b"], received)
+
+
+from jinja2 import Template
+from pygentic.messages import IncrementalChatRenderer, group_messages
+
+
+class IncrementalChatRendererTests(unittest.TestCase):
+    def setUp(self):
+        self.template = Template("<s>{% for m in messages %}[{{ m.role }}:{{ m.content.render() }}]{% endfor %}")
+        self.factory = JinjaChatFactory('llama3', None)
+        self.renderer = IncrementalChatRenderer(self.template, '>>>')
+
+    def render_from_scratch(self, messages):
+        groups = [collate(group) for group in group_messages(messages)]
+        return self.template.render(messages=groups) + '>>>'
+
+    def test_matches_full_render(self):
+        history = [self.factory.create_system_msg("sys"), self.factory.create_user_msg("hi")]
+        self.assertEqual(self.render_from_scratch(history), self.renderer(history))
+
+        history.append(self.factory.create_ai_msg("hello"))
+        self.assertEqual(self.render_from_scratch(history), self.renderer(history))
+
+        history.append(self.factory.create_ai_msg(" there"))
+        self.assertEqual(self.render_from_scratch(history), self.renderer(history))
+
+    def test_clone(self):
+        history = [self.factory.create_user_msg("a"), self.factory.create_ai_msg("b")]
+        self.renderer(history)
+        clone = self.renderer.clone()
+
+        branch = history + [self.factory.create_user_msg("c")]
+        self.assertEqual(self.render_from_scratch(branch), clone(branch))
+        self.assertEqual(self.render_from_scratch(history), self.renderer(history))
+
+    def test_replaced_history(self):
+        history = [self.factory.create_user_msg("a"), self.factory.create_ai_msg("b")]
+        self.renderer(history)
+        history = [self.factory.create_user_msg("c")]
+        self.assertEqual(self.render_from_scratch(history), self.renderer(history))
+
+
+from pygentic import TruncatingContextManager
+
+
+class TruncatingContextManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.factory = JinjaChatFactory('llama3', None)
+        self.history = [self.factory.create_system_msg("s" * 10),
+                        self.factory.create_user_msg("p" * 10),
+                        self.factory.create_ai_msg("a" * 10),
+                        self.factory.create_tool_call("tool", {}),
+                        self.factory.create_tool_result("tool", "r"),
+                        self.factory.create_ai_msg("b" * 10)]
+
+    def test_history_within_budget(self):
+        manager = TruncatingContextManager(1000, count_tokens=len)
+        self.assertEqual(self.history, manager(self.history))
+
+    def test_drops_oldest_groups(self):
+        manager = TruncatingContextManager(30, count_tokens=len)
+        pruned = manager(self.history)
+        self.assertEqual(self.history[:2] + self.history[-1:], pruned)
+
+    def test_keeps_tool_call_with_result(self):
+        budget = sum(len(msg.content.render()) for msg in self.history) - 1
+        manager = TruncatingContextManager(budget, count_tokens=len)
+        pruned = manager(self.history)
+        self.assertEqual(self.history[:2] + self.history[3:], pruned)
+
+    def test_pins_messages_of_current_call(self):
+        second_call = [self.factory.create_system_msg("t" * 10),
+                       self.factory.create_user_msg("q" * 10),
+                       self.factory.create_ai_msg("c" * 10)]
+        history = self.history + second_call
+        manager = TruncatingContextManager(30, count_tokens=len)
+        self.assertEqual(second_call, manager(history, start=len(self.history)))
+
+    def test_sizes_counted_once_per_message(self):
+        counted = []
+
+        def count_tokens(text):
+            counted.append(text)
+            return len(text)
+
+        manager = TruncatingContextManager(30, count_tokens=count_tokens)
+        manager(self.history[:4])
+        manager(self.history)
+        self.assertEqual(len(self.history), len(counted))
+
+    def test_agent_called_twice_keeps_current_prompt(self):
+        class RecordingLLM(BaseLLM):
+            def __init__(self):
+                super().__init__()
+                self.prompts = []
+
+            def __call__(self, text):
+                self.prompts.append(text)
+                return '<|tool_use_start|>{"tool_name": "done_tool", "args": {}}<|tool_use_end|>'
+
+        llm = RecordingLLM()
+        agent = Agent(llm, {}, output_device=OutputDevice(), temp_output_device=OutputDevice(),
+                      context_manager=TruncatingContextManager(20))
+        agent({"text": "first task"})
+        agent({"text": "second task"})
+
+        self.assertIn("second task", llm.prompts[-1])
+        self.assertNotIn("first task", llm.prompts[-1])
+
+
+from pygentic import ToolCaller, cacheable
+
+
+class ToolCallerCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def tool(x, y):
+            self.calls.append((x, y))
+            return x + y
+
+        class Foo:
+            tools = {'plain': tool, 'cached': cacheable()(lambda **kwargs: tool(**kwargs))}
+
+        self.caller = ToolCaller(Foo(), JinjaChatFactory('llama3', None))
+
+    def test_cacheable_tool_called_once(self):
+        first = self.caller('cached', {'x': 1, 'y': 2})
+        second = self.caller('cached', {'y': 2, 'x': 1})
+        self.assertEqual(3, first.content.result)
+        self.assertEqual(3, second.content.result)
+        self.assertEqual(1, len(self.calls))
+
+    def test_different_args_not_shared(self):
+        self.caller('cached', {'x': 1, 'y': 2})
+        self.caller('cached', {'x': 2, 'y': 2})
+        self.assertEqual(2, len(self.calls))
+
+    def test_plain_tool_not_cached(self):
+        self.caller('plain', {'x': 1, 'y': 2})
+        self.caller('plain', {'x': 1, 'y': 2})
+        self.assertEqual(2, len(self.calls))
+
+
+from pygentic.llm_backends import LLMPool
+
+
+class LLMPoolTests(unittest.TestCase):
+    class EchoLLM:
+        def __init__(self):
+            self.response_data = {}
+
+        def __call__(self, text):
+            self.response_data = {"prompt": text, "backend": id(self)}
+            yield text
+
+    def test_streams_backend_response(self):
+        pool = LLMPool(self.EchoLLM, 2)
+        self.assertEqual(["hello"], list(pool("hello")))
+        self.assertEqual("hello", pool.response_data["prompt"])
+
+    def test_sequential_calls_reuse_backend(self):
+        pool = LLMPool(self.EchoLLM, 2)
+        list(pool("first"))
+        first_backend = pool.response_data["backend"]
+        list(pool("second"))
+        self.assertEqual(first_backend, pool.response_data["backend"])
+
+
+import requests
+from pygentic.llm_backends import LlamaCpp, GenerationSpec
+
+
+def make_sse_body(tokens, stopping_word="", **final):
+    events = [{"content": token, "stop": False} for token in tokens]
+    last = {"content": "", "stop": True, "stopping_word": stopping_word, "tokens_evaluated": 5}
+    last.update(final)
+    events.append(last)
+    return b"".join(b"data: " + json.dumps(event).encode() + b"\n\n" for event in events)
+
+
+class FakeRaw:
+    """Stands in for a urllib3 response, delivering the body in small pieces that split lines"""
+    def __init__(self, body, chunked=True, piece_size=7):
+        self.pieces = [body[i:i + piece_size] for i in range(0, len(body), piece_size)]
+        self.chunked = chunked
+        self.read_sizes = []
+        self.closed = False
+
+    def stream(self, amt, decode_content=None):
+        self.read_sizes.append(amt)
+        yield from self.pieces
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRequestMaker:
+    def __init__(self, body, chunked=True):
+        self.body = body
+        self.chunked = chunked
+        self.payloads = []
+        self.responses = []
+
+    def post(self, url, data=None, headers=None, stream=False):
+        self.payloads.append(json.loads(data))
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = FakeRaw(self.body, self.chunked)
+        self.responses.append(response)
+        return response
+
+
+class LlamaCppCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def make_llm(self, sampling_config, stop_sequences=None):
+        spec = GenerationSpec(dict(sampling_config), "</s>", stop_sequences)
+        # a long url pushes the sampling settings past the first 64 bytes of the namespace
+        llm = LlamaCpp("http://llama-server.internal.example.com:8080/api/v1/models/default", spec,
+                       cache=self.cache)
+        llm.request_maker = FakeRequestMaker(make_sse_body(["Hello", " world"]))
+        return llm
+
+    def test_same_settings_hit_cache(self):
+        first = self.make_llm({"temperature": 0, "top_k": 40})
+        second = self.make_llm({"temperature": 0, "top_k": 40})
+        self.assertEqual("Hello world", "".join(first("prompt")))
+        self.assertEqual("Hello world", "".join(second("prompt")))
+        self.assertEqual(0, len(second.request_maker.payloads))
+
+    def test_different_sampling_settings_miss_cache(self):
+        first = self.make_llm({"temperature": 0, "top_k": 40, "top_p": 0.9})
+        second = self.make_llm({"temperature": 0, "top_k": 1, "top_p": 0.5})
+        list(first("prompt"))
+        list(second("prompt"))
+        self.assertEqual(1, len(second.request_maker.payloads))
+
+    def test_different_stop_sequences_miss_cache(self):
+        first = self.make_llm({"temperature": 0}, stop_sequences=["###"])
+        second = self.make_llm({"temperature": 0}, stop_sequences=["<|tool_use_end|>"])
+        list(first("prompt"))
+        list(second("prompt"))
+        self.assertEqual(1, len(second.request_maker.payloads))
+
+
+class LlamaCppSlotTests(unittest.TestCase):
+    def test_prompt_cached_without_pinning_slot(self):
+        llm = LlamaCpp("http://localhost:8080", GenerationSpec({}, "</s>"))
+        llm.request_maker = FakeRequestMaker(make_sse_body(["Hi"], id_slot=3))
+        list(llm("first prompt"))
+        list(llm("first prompt and more"))
+
+        for payload in llm.request_maker.payloads:
+            self.assertTrue(payload["cache_prompt"])
+            self.assertNotIn("id_slot", payload)
+            self.assertNotIn("slot_id", payload)
+
+
+class LlamaCppStreamingTests(unittest.TestCase):
+    def make_llm(self, body, chunked=True):
+        llm = LlamaCpp("http://localhost:8080", GenerationSpec({}, "</s>"))
+        llm.request_maker = FakeRequestMaker(body, chunked)
+        return llm
+
+    def test_chunked_response_read_in_large_chunks(self):
+        llm = self.make_llm(make_sse_body(["Hello", ", ", "world"]))
+        self.assertEqual(["Hello", ", ", "world", ""], list(llm.stream_response("prompt", {})))
+
+        response = llm.request_maker.responses[0]
+        self.assertEqual([8192], response.raw.read_sizes)
+        self.assertEqual(5, llm.response_data["tokens_evaluated"])
+
+    def test_stopping_word_ends_stream(self):
+        body = make_sse_body(["Hello", " world"], stopping_word="<|tool_use_end|>")
+        body += b'data: {"content": "ignored", "stop": false}\n\n'
+        llm = self.make_llm(body)
+        tokens = list(llm.stream_response("prompt", {}))
+
+        self.assertEqual(["Hello", " world", "<|tool_use_end|>"], tokens)
+        self.assertTrue(llm.request_maker.responses[0].raw.closed)
+
+    def test_unchunked_response_read_byte_by_byte(self):
+        llm = self.make_llm(make_sse_body(["Hello", " world"]), chunked=False)
+        self.assertEqual(["Hello", " world", ""], list(llm.stream_response("prompt", {})))
+        self.assertEqual([1], llm.request_maker.responses[0].raw.read_sizes)
+
+
+import os
+import tempfile
+from pygentic import FileOutputDevice
+
+
+class FileOutputDeviceTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'log.txt')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_streamed_tokens_not_duplicated(self):
+        with FileOutputDevice(self.path) as device:
+            device.on_token("hello ")
+            device.on_token("world")
+            device("hello world")
+            device("next message")
+
+        self.assertEqual("hello worldnext message\n", self.read())
+
+    def test_flushed_on_message(self):
+        device = FileOutputDevice(self.path)
+        device("message")
+        self.assertEqual("message\n", self.read())
+        device.close()
+
+
+from pygentic import FileLoadingConfig, OutputDevice
+from pygentic.loaders import get_default_loaders
+
+
+class PreparePromptTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_files_loaded_in_order(self):
+        paths = []
+        for i in range(4):
+            path = os.path.join(self.dir.name, f'file{i}.txt')
+            with open(path, 'w') as f:
+                f.write(f'content {i}')
+            paths.append(path)
+
+        agent = Agent(None, {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+        config = FileLoadingConfig(get_default_loaders(agent.chat_factory), [], True)
+        agent.set_loading_config(config)
+
+        prompt = agent._prepare_prompt_message({"input": "x"}, [{"path": path} for path in paths])
+        text = prompt.content.render()
+        offsets = [text.index(f'content {i}') for i in range(4)]
+        self.assertEqual(sorted(offsets), offsets)
+
+
+class HistoryBackupTests(unittest.TestCase):
+    def test_restore_drops_messages_added_after_backup(self):
+        agent = Agent(None, {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+        first = agent.chat_factory.create_user_msg("first")
+        agent.history.append(first)
+        agent.backup_history()
+
+        agent.history.append(agent.chat_factory.create_user_msg("second"))
+        agent.restore_history()
+        self.assertEqual([first], agent.history)
+
+        agent.history.append(agent.chat_factory.create_user_msg("third"))
+        agent.restore_history()
+        self.assertEqual([first], agent.history)
+
+
+from pygentic import Delegator
+
+
+class DelegatorFanOutTests(unittest.TestCase):
+    def setUp(self):
+        self.agent = Mock()
+        self.agent.sub_agents = {
+            "a": Mock(return_value="result a"),
+            "b": Mock(side_effect=RunOutOfContextError("out of context")),
+        }
+        self.chat_factory = Mock()
+        self.delegator = Delegator(self.agent, self.chat_factory)
+
+    def test_results_reported_in_order_of_names(self):
+        self.delegator("delegate", {"name": ["a", "b"], "inputs": [{"x": 1}, {"x": 2}]})
+
+        self.agent.sub_agents["a"].assert_called_once_with({"x": 1})
+        self.assertEqual(3, self.agent.sub_agents["b"].call_count)
+        expected = [{"name": "a", "result": "result a"}, {"name": "b", "error": "out of context"}]
+        self.chat_factory.create_tool_result.assert_called_once_with("delegate", expected)
+
+    def test_duplicate_names_rejected(self):
+        self.delegator("delegate", {"name": ["a", "a"], "inputs": {}})
+        self.chat_factory.create_tool_error.assert_called_once()
+        self.agent.sub_agents["a"].assert_not_called()
+
+
+    def test_unknown_names_rejected(self):
+        self.delegator("delegate", {"name": ["a", "c"], "inputs": [{}, {}]})
+        self.chat_factory.create_tool_error.assert_called_once()
+        self.agent.sub_agents["a"].assert_not_called()
+
+        self.delegator("delegate", {"name": "c", "inputs": {}})
+        self.assertEqual(2, self.chat_factory.create_tool_error.call_count)
+
+    def test_unhashable_names_rejected(self):
+        self.delegator("delegate", {"name": [["a"]], "inputs": [{}]})
+        self.delegator("delegate", {"name": [{"a": 1}], "inputs": [{}]})
+        self.delegator("delegate", {"name": {"a": 1}, "inputs": {}})
+        self.assertEqual(3, self.chat_factory.create_tool_error.call_count)
+        self.agent.sub_agents["a"].assert_not_called()
+
+    def test_same_sub_agent_under_two_names_rejected(self):
+        self.agent.sub_agents["c"] = self.agent.sub_agents["a"]
+        self.delegator("delegate", {"name": ["a", "c"], "inputs": [{}, {}]})
+        self.chat_factory.create_tool_error.assert_called_once()
+        self.agent.sub_agents["a"].assert_not_called()
+
+
+class BarrierRequestMaker(FakeRequestMaker):
+    """Blocks each request until the expected number of requests are in flight at once"""
+    def __init__(self, body, parties):
+        super().__init__(body)
+        self.barrier = threading.Barrier(parties, timeout=5)
+
+    def post(self, *args, **kwargs):
+        self.barrier.wait()
+        return super().post(*args, **kwargs)
+
+
+class DelegatorConcurrencyTests(unittest.TestCase):
+    def make_sub_agent(self, llm):
+        return Agent(llm, {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+
+    def test_sub_agents_run_concurrently_on_shared_backend(self):
+        tokens = ['<|tool_use_start|>{"tool_name": "done_tool", "args": {"answer": 42}}']
+        body = make_sse_body(tokens, stopping_word='<|tool_use_end|>')
+        llm = LlamaCpp("http://localhost:8080", GenerationSpec({"temperature": 0}, "</s>"), cache=ResponseCache())
+        llm.request_maker = BarrierRequestMaker(body, parties=2)
+
+        parent = Mock()
+        parent.sub_agents = {"a": self.make_sub_agent(llm), "b": self.make_sub_agent(llm)}
+        chat_factory = Mock()
+        Delegator(parent, chat_factory)("delegate", {"name": ["a", "b"], "inputs": [{"x": 1}, {"x": 2}]})
+
+        expected = [{"name": "a", "result": {"answer": 42}}, {"name": "b", "result": {"answer": 42}}]
+        chat_factory.create_tool_result.assert_called_once_with("delegate", expected)
+        self.assertEqual(2, len(llm.request_maker.payloads))
+        self.assertEqual(2, llm.cache.stats()["misses"])
+
+
+class OutputDeviceTests(unittest.TestCase):
+    def test_wants_text_only_when_call_overridden(self):
+        class PrintingDevice(OutputDevice):
+            def __call__(self, new_text):
+                print(new_text)
+
+        self.assertFalse(OutputDevice().wants_text)
+        self.assertTrue(PrintingDevice().wants_text)
+        self.assertTrue(FileOutputDevice('unused.txt').wants_text)
+
+
+from pygentic import TokenBudget, BudgetExceededError
+
+
+class TokenBudgetTests(unittest.TestCase):
+    def test_raises_once_quota_exceeded(self):
+        budget = TokenBudget(3)
+        budget.increment(3)
+        with self.assertRaises(BudgetExceededError) as cm:
+            budget.increment()
+        self.assertEqual(4, cm.exception.n_tokens)
+        self.assertEqual(3, cm.exception.quota)
+
+
+from pygentic import run_agent
+from pygentic.messenger import messenger
+
+
+class RunAgentTests(unittest.TestCase):
+    class EarlyStopLLM(BaseLLM):
+        """Keeps generating after the tool call, but never sends final stats"""
+        def __init__(self):
+            super().__init__()
+            self.response_data = {}
+
+        def __call__(self, text):
+            tokens = ['<|tool_use_start|>{"tool_name": "done_tool", "args": {}}', '<|tool_use_end|>', 'more']
+            for token in tokens:
+                self.response_data = {"content": token, "stop": False}
+                yield token
+
+    def test_prompt_counted_when_stream_cut_on_end_tag(self):
+        agent = Agent(self.EarlyStopLLM(), {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+        inputs = {"text": "word " * 200}
+        self.assertRaises(BudgetExceededError, run_agent, agent, inputs, max_eval=100, max_total=100000)
+
+        agent = Agent(self.EarlyStopLLM(), {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+        self.assertEqual({}, run_agent(agent, inputs, max_eval=100000, max_total=100000))
+
+    def test_budget_callbacks_unsubscribed(self):
+        before = {etype: len(receivers) for etype, receivers in messenger.subscribers.items()}
+        agent = Mock(return_value="result")
+        self.assertEqual("result", run_agent(agent, {}))
+
+        agent = Mock(side_effect=RuntimeError("failed"))
+        self.assertRaises(RuntimeError, run_agent, agent, {})
+
+        after = {etype: len(receivers) for etype, receivers in messenger.subscribers.items()}
+        self.assertEqual(before, after)
+
+
+from pygentic.messenger import TokenArrivedEvent, GenerationCompleteEvent
+
+
+class EventTests(unittest.TestCase):
+    def test_events_have_no_instance_dict(self):
+        for event in [TokenArrivedEvent("token"), GenerationCompleteEvent(("text", {}))]:
+            self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_responses_have_no_instance_dict(self):
+        from pygentic import RegularResponse, SolutionResponse
+        for response in [RegularResponse("text"), SolutionResponse("text", {})]:
+            self.assertFalse(hasattr(response, '__dict__'))
+
+
+from pygentic import TokenBatcher, OutputDevice, AiAssistant
+
+
+class TokenBatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        device = OutputDevice()
+        device.on_token = self.received.append
+        self.device = device
+
+    def test_batches_by_size(self):
+        batcher = TokenBatcher(self.device, batch_size=3)
+        for token in ["a", "b", "c", "d"]:
+            batcher(token)
+        self.assertEqual(["abc"], self.received)
+
+        batcher.flush()
+        self.assertEqual(["abc", "d"], self.received)
+
+    def test_flushes_on_boundary(self):
+        batcher = TokenBatcher(self.device)
+        for token in ["Hi", " there", ".", " More"]:
+            batcher(token)
+        self.assertEqual(["Hi there."], self.received)
+
+    def test_empty_flush_is_noop(self):
+        TokenBatcher(self.device).flush()
+        self.assertEqual([], self.received)
+
+    def test_clarification_flushed_to_parent_device(self):
+        parent = Agent(MockLLM(''), {}, output_device=self.device, temp_output_device=OutputDevice())
+        parent.token_batcher = TokenBatcher(self.device)
+
+        def complete(input_text):
+            parent.token_batcher("The answer")
+            return "The answer"
+
+        parent.completer = Mock(side_effect=complete)
+        self.assertEqual("The answer", AiAssistant(parent).ask_question("What is it?"))
+        self.assertEqual(["The answer"], self.received)
+
+
+import asyncio
+
+
+class AsyncAgentTests(unittest.TestCase):
+    class DoneLLM(BaseLLM):
+        def __init__(self, value):
+            super().__init__()
+            self.value = value
+            self.response_data = {}
+
+        def __call__(self, text):
+            yield f'<|tool_use_start|>{{"tool_name": "done_tool", "args": {{"x": {self.value}}}}}<|tool_use_end|>'
+
+    def make_agent(self, value):
+        return Agent(self.DoneLLM(value), {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+
+    def test_agents_awaited_concurrently(self):
+        async def run_all():
+            agents = [self.make_agent(i) for i in range(3)]
+            return await asyncio.gather(*(agent.acall({"input": ""}) for agent in agents))
+
+        results = asyncio.run(run_all())
+        self.assertEqual([{"x": 0}, {"x": 1}, {"x": 2}], results)
+
+
+class StreamToDeviceTests(unittest.TestCase):
+    def setUp(self):
+        self.agent = Agent(None, {}, output_device=OutputDevice(), temp_output_device=OutputDevice())
+        self.received = []
+        self.agent.token_batcher = self.received.append
+        self.on_token = self.agent._stream_to_device(self.agent.tool_use_helper)
+
+    def test_tool_use_hidden(self):
+        tokens = ["Hi", " <|tool_use_start|>", '{"tool_name": "a"}', "<|tool_use_end|>", " bye"]
+        for token in tokens:
+            self.on_token(token)
+        self.assertEqual(["Hi", " <|tool_use_start|>", " bye"], self.received)
+
+    def test_tags_split_across_tokens(self):
+        tokens = ["<|tool_", "use_start|>", "{}", "<|tool_use", "_end|>", "after"]
+        for token in tokens:
+            self.on_token(token)
+        self.assertEqual(["<|tool_", "use_start|>", "after"], self.received)
+
+    def test_both_tags_in_one_token(self):
+        self.on_token('<|tool_use_start|>{}<|tool_use_end|>')
+        self.on_token("text")
+        self.assertEqual(['<|tool_use_start|>{}<|tool_use_end|>', "text"], self.received)
+
+
+from pygentic import SimpleTagBasedToolUse, close_json
+
+
+class CloseJsonTests(unittest.TestCase):
+    def test_complete_json_unchanged(self):
+        self.assertEqual('{"a": [1, 2]}', close_json('{"a": [1, 2]}'))
+
+    def test_closes_brackets_in_order(self):
+        self.assertEqual('{"a": [1, {"b": 2}]}', close_json('{"a": [1, {"b": 2'))
+
+    def test_closes_string(self):
+        self.assertEqual('{"a": "text"}', close_json('{"a": "text'))
+
+    def test_brackets_inside_strings_ignored(self):
+        self.assertEqual('{"a": "}{[\\"]"}', close_json('{"a": "}{[\\"]"'))
+
+    def test_mismatched_brackets(self):
+        self.assertEqual('{"a": ]', close_json('{"a": ]'))
+
+    def test_recovery_in_parse(self):
+        tool_use = SimpleTagBasedToolUse.create_default()
+        body = '{"tool_name": "my_tool", "args": {"arg1": [1, 2'
+        self.assertEqual(("my_tool", {"arg1": [1, 2]}), tool_use.parse(body))
+
+    def test_try_parse_returns_error_instead_of_raising(self):
+        tool_use = SimpleTagBasedToolUse.create_default()
+        self.assertEqual((("my_tool", {}), None), tool_use.try_parse('{"tool_name": "my_tool"}'))
+
+        result, error = tool_use.try_parse('{"args": {}}')
+        self.assertIsNone(result)
+        self.assertEqual("Tool name not found in JSON string", error)
+
+        result, error = tool_use.try_parse('not json')
+        self.assertIsNone(result)
+        self.assertTrue(error.startswith("Invalid JSON string"))
+
 
 if __name__ == '__main__':
     unittest.main()